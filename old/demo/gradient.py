@@ -19,7 +19,7 @@ def main(fn="v4l2:///dev/video0"):
         vis.color = DF_IMAGE_RGB
         Show(vis)
     g.verify()
-    while g.process() == SUCCESS:
+    while g.process(block=True) == SUCCESS:
         pass
 
 if __name__ == '__main__':
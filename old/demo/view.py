@@ -5,7 +5,7 @@ def main(path="v4l2:///dev/video0"):
         img = Play(path)
         Show(img)
     g.verify()
-    while g.process() == SUCCESS:
+    while g.process(block=True) == SUCCESS:
         pass
 
 if __name__ == '__main__':
@@ -35,6 +35,10 @@ struct avplay *avplay_new(char *fn) {
 
     
     p->format_ctx = avformat_alloc_context();
+    if (v4l) {
+        // Deliver the latest captured frame instead of queueing them up
+        p->format_ctx->flags |= AVFMT_FLAG_NOBUFFER;
+    }
     if (avformat_open_input(&p->format_ctx, fn, iFormat, NULL) != 0) return NULL;
     if (avformat_find_stream_info(p->format_ctx, NULL) < 0) return NULL;
     int i;
@@ -77,10 +81,15 @@ struct avplay *avplay_new(char *fn) {
 
     p->width = p->codec_ctx->width;
     p->height = p->codec_ctx->height;
+    p->live = v4l;
+    AVStream *stream = p->format_ctx->streams[p->video_stream_index];
+    AVRational rate = stream->avg_frame_rate;
+    if (rate.num <= 0 || rate.den <= 0) rate = stream->r_frame_rate;
+    p->frame_duration = (rate.num > 0 && rate.den > 0) ? 1.0 / av_q2d(rate) : 0.0;
     return p;
 }
 
-int avplay_next(struct avplay *p, uint8_t *img) {
+static int avplay_decode(struct avplay *p, uint8_t *img, int64_t *pts) {
     while (1) {
         AVPacket packet;
         int frame_ok = av_read_frame(p->format_ctx, &packet);
@@ -93,7 +102,12 @@ int avplay_next(struct avplay *p, uint8_t *img) {
             int frameFinished;
             avcodec_decode_video2(p->codec_ctx, p->frame, &frameFinished, &packet);
             if (frameFinished) {
-                p->pts = p->frame->pkt_pts;
+                // The frame is converted straight into the image of the graph,
+                // which is also what ShowNode reads from, or into a slot of
+                // the prefetch ring. The address of that image is compiled
+                // into the graph, so the decoder or capture buffers can't be
+                // used in its place without this conversion.
+                *pts = p->frame->pkt_pts;
                 uint8_t *const planes[] = {img};
                 const int strides[] = {p->width * 3};
                 sws_scale(p->convert_ctx, 
@@ -109,7 +123,141 @@ int avplay_next(struct avplay *p, uint8_t *img) {
     }
 }
 
+static void *avplay_prefetch(void *arg) {
+    struct avplay *p = arg;
+    pthread_mutex_lock(&p->lock);
+    while (!p->stop) {
+        if (p->seek) {
+            av_seek_frame(p->format_ctx, p->video_stream_index, p->seek_pts, 0);
+            p->seek = 0;
+            p->eof = 0;
+        }
+        if (p->count == p->slots || p->eof) {
+            pthread_cond_wait(&p->cond, &p->lock);
+            continue;
+        }
+        // The free slot is not touched by avplay_next(), so it is decoded
+        // into without holding the lock
+        int slot = (p->head + p->count) % p->slots;
+        int generation = p->generation;
+        pthread_mutex_unlock(&p->lock);
+        int64_t pts;
+        int err = avplay_decode(p, p->ring[slot], &pts);
+        pthread_mutex_lock(&p->lock);
+        if (generation != p->generation) {
+            continue; // Decoded before a seek
+        }
+        if (err) {
+            p->eof = 1;
+        } else {
+            p->ring_pts[slot] = pts;
+            p->count++;
+        }
+        pthread_cond_broadcast(&p->cond);
+    }
+    pthread_mutex_unlock(&p->lock);
+    return NULL;
+}
+
+static void avplay_free_ring(struct avplay *p, int slots) {
+    int i;
+    if (p->ring) {
+        for (i = 0; i < slots; i++) free(p->ring[i]);
+    }
+    free(p->ring);
+    free(p->ring_pts);
+    p->ring = NULL;
+    p->ring_pts = NULL;
+}
+
+// Decode up to slots frames ahead in a background thread, overlapping the
+// decoding with the processing of the graph. Not meant for live sources,
+// where it would only add latency. Once started, avplay_next() and
+// avplay_seek() have to be called from the same thread, and
+// avplay_stop_prefetch() before the player is released.
+int avplay_start_prefetch(struct avplay *p, int slots) {
+    int i, size = p->width * p->height * 3;
+    if (p->prefetching || slots < 1) return -1;
+    p->ring = calloc(slots, sizeof(uint8_t *));
+    p->ring_pts = calloc(slots, sizeof(int64_t));
+    if (!p->ring || !p->ring_pts) goto fail;
+    for (i = 0; i < slots; i++) {
+        if (!(p->ring[i] = malloc(size))) goto fail;
+    }
+    p->slots = slots;
+    p->head = p->count = 0;
+    p->stop = p->eof = p->seek = 0;
+    pthread_mutex_init(&p->lock, NULL);
+    pthread_cond_init(&p->cond, NULL);
+    if (pthread_create(&p->thread, NULL, avplay_prefetch, p)) {
+        pthread_cond_destroy(&p->cond);
+        pthread_mutex_destroy(&p->lock);
+        goto fail;
+    }
+    p->prefetching = 1;
+    return 0;
+fail:
+    avplay_free_ring(p, slots);
+    return -1;
+}
+
+// Stop the decoding thread and free the ring. The frames decoded ahead are
+// dropped and avplay_next() decodes on the calling thread again.
+void avplay_stop_prefetch(struct avplay *p) {
+    if (!p->prefetching) return;
+    pthread_mutex_lock(&p->lock);
+    p->stop = 1;
+    pthread_cond_broadcast(&p->cond);
+    pthread_mutex_unlock(&p->lock);
+    pthread_join(p->thread, NULL);
+    if (p->seek) {
+        av_seek_frame(p->format_ctx, p->video_stream_index, p->seek_pts, 0);
+        p->seek = 0;
+    }
+    pthread_cond_destroy(&p->cond);
+    pthread_mutex_destroy(&p->lock);
+    avplay_free_ring(p, p->slots);
+    p->prefetching = p->stop = p->count = 0;
+}
+
+int avplay_next(struct avplay *p, uint8_t *img) {
+    if (!p->prefetching) return avplay_decode(p, img, &p->pts);
+    pthread_mutex_lock(&p->lock);
+    while (p->count == 0 && !p->eof) {
+        pthread_cond_wait(&p->cond, &p->lock);
+    }
+    if (p->count == 0) {
+        pthread_mutex_unlock(&p->lock);
+        return -1;
+    }
+    int slot = p->head;
+    pthread_mutex_unlock(&p->lock);
+    // The filled slot is not touched by the decoding thread until released.
+    // The image can't take the place of the slot, as its address is compiled
+    // into the graph, so the frame is copied. That is still cheaper than
+    // leaving the colour conversion to this thread.
+    memcpy(img, p->ring[slot], p->width * p->height * 3);
+    pthread_mutex_lock(&p->lock);
+    p->pts = p->ring_pts[slot];
+    p->head = (slot + 1) % p->slots;
+    p->count--;
+    pthread_cond_broadcast(&p->cond);
+    pthread_mutex_unlock(&p->lock);
+    return 0;
+}
+
 void avplay_seek(struct avplay *p, int64_t pts) {
-    av_seek_frame(p->format_ctx, p->video_stream_index, pts, 0);
+    if (!p->prefetching) {
+        av_seek_frame(p->format_ctx, p->video_stream_index, pts, 0);
+        return;
+    }
+    // Handled by the decoding thread, dropping the frames decoded ahead
+    pthread_mutex_lock(&p->lock);
+    p->seek = 1;
+    p->seek_pts = pts;
+    p->count = 0;
+    p->generation++;
+    pthread_cond_broadcast(&p->cond);
+    pthread_mutex_unlock(&p->lock);
 }
 
@@ -6,6 +6,7 @@
 #include <libavdevice/avdevice.h>
 #include <libswscale/swscale.h>
 #include <libavutil/pixfmt.h>
+#include <pthread.h>
 
 struct avplay {
     AVCodecContext  *codec_ctx;
@@ -16,11 +17,25 @@ struct avplay {
     int video_stream_index;
     int64_t pts;
     int width, height;
+    double frame_duration;
+    int live;
+
+    // Ring of frames decoded ahead by a background thread, see
+    // avplay_start_prefetch(). Frames are added at (head + count) % slots.
+    int prefetching, stop, eof, slots, head, count, generation;
+    uint8_t **ring;
+    int64_t *ring_pts, seek_pts;
+    int seek;
+    pthread_t thread;
+    pthread_mutex_t lock;
+    pthread_cond_t cond;
 };
 
 
 void avplay_seek(struct avplay *p, int64_t pts);
 struct avplay *avplay_new(char *fn);
 int avplay_next(struct avplay *p, uint8_t *img);
+int avplay_start_prefetch(struct avplay *p, int slots);
+void avplay_stop_prefetch(struct avplay *p);
 
 #endif
\ No newline at end of file
@@ -1,15 +1,78 @@
 import pyvx.model as model
 from pyvx.types import *
-from pyvx.codegen import Code
+from pyvx.codegen import Code, NoFastPath
 from cffi import FFI
-from collections import defaultdict
+from collections import defaultdict, deque
 from itertools import chain
 import threading
+import platform
+import numpy
 import os
 import re
+import shlex
+import hashlib
+import subprocess
+from distutils.sysconfig import get_config_var
+from distutils.spawn import find_executable
+from cffi.verifier import Verifier
 from tempfile import mkdtemp
 from shutil import rmtree
 
+# Shared by the casts and allocations below, as creating an FFI takes 80us
+_ffi = FFI()
+_new_uncleared = _ffi.new_allocator(should_clear_after_alloc=False)
+
+_native_target = []
+
+def compiler():
+    """ The command line of the C compiler ffi.verify() calls. """
+    return shlex.split(os.environ.get('CC') or get_config_var('CC') or 'cc')
+
+def have_compiler():
+    return find_executable(compiler()[0]) is not None
+
+def native_target():
+    """ A hash of the instruction set flags ``-march=native`` turns into on
+        this host, as the compiler driver passes them on, or ``None`` if
+        they can't be found out.
+    """
+    if not _native_target:
+        cc = compiler()
+        try:
+            p = subprocess.Popen(cc + ['-march=native', '-###', '-E', '-'],
+                                 stdin=open(os.devnull), stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            out = p.communicate()[1]
+        except OSError:
+            out = ''
+        lines = [l for l in out.splitlines() if '-march=' in l or '-target-cpu' in l]
+        _native_target.append(hashlib.sha1(lines[-1]).hexdigest() if lines else None)
+    return _native_target[0]
+
+def evict_cache(cache_dir, keep):
+    """ Remove all but the ``keep`` most recently used modules and numba
+        kernels from ``cache_dir``, along with their sources.
+    """
+    entries = defaultdict(list)
+    for d in (cache_dir, os.path.join(cache_dir, '__pycache__')):
+        try:
+            names = os.listdir(d)
+        except OSError:
+            continue
+        for name in names:
+            fn = os.path.join(d, name)
+            try:
+                if os.path.isfile(fn):
+                    entries[name.split('.')[0]].append((os.path.getmtime(fn), fn))
+            except OSError:
+                pass
+    for files in sorted(entries.values(), key=max, reverse=True)[keep:]:
+        for mtime, fn in files:
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+
 class Context(model.Context):
     def create_image(self, width, height, color):
         return CoreImage(width, height, color, context=self, virtual=False)
@@ -40,6 +103,10 @@ class CoreImage(model.Image):
     optimized_out = False
     color_space = COLOR_SPACE_DEFAULT
     channel_range = CHANNEL_RANGE_FULL
+    alignment = 64
+    shares_buffer = False
+    # The allocation holding the pixels, if made by pyvx rather than passed in
+    _buffer = None
 
     def __init__(self, width=0, height=0, color=DF_IMAGE_VIRT,
                  data=None, context=None, virtual=None, graph=None):
@@ -80,19 +147,29 @@ class CoreImage(model.Image):
         if hasattr(data, 'typecode'):
             assert data.typecode == self.image_format.dtype
         if hasattr(data, 'to_cffi'):
-            self.data = data.to_cffi(FFI())
+            self.data = data.to_cffi(_ffi)
         elif hasattr(data, 'buffer_info'):
             addr, l = data.buffer_info()
             assert l == self.width * self.height * self.image_format.items
-            self.data = FFI().cast(self.image_format.ctype + ' *', addr)
+            self.data = _ffi.cast(self.image_format.ctype + ' *', addr)
+        elif hasattr(data, '__array_interface__'):
+            # numpy arrays are used in place, which requires them to be laid
+            # out as the image
+            iface = data.__array_interface__
+            assert iface.get('strides') is None
+            assert numpy.dtype(iface['typestr']) == self.image_format.dtype
+            assert numpy.prod(iface['shape']) == \
+                self.width * self.height * self.image_format.items
+            self.data = _ffi.cast(self.image_format.ctype + ' *', iface['data'][0])
         else:
             raise NotImplementedError(
                 "Dont know how to convert %r to a cffi buffer" % data)
         self._keep_alive_original_data = data
+        self._buffer = None
 
     def force(self, data=None):
         if data is not None:
-            self.set_data_pointer(data)
+            self._set_data_pointer(data)
         self.virtual = False
 
     def ensure_shape(self, width_or_image, height=None):
@@ -122,20 +199,53 @@ class CoreImage(model.Image):
         if self.image_format.items != image.image_format.items:
             raise InvalidFormatError
 
-    def alloc(self):
+    def alloc_size(self):
+        """ The number of bytes ``alloc()`` would allocate, ``0`` if the image
+            already has its pixel data or is kept in a local variable.
+        """
+        if self.optimized_out or self.data is not None:
+            return 0
+        fmt = self.image_format
+        return self.width * self.height * fmt.items * fmt.dtype.itemsize
+
+    def alloc(self, code, index):
         if self.optimized_out:
             self.ctype = self.image_format.ctype
-            self.csym = "__img%d" % self.count
+            self.csym = "__img%d" % index
             self.cdeclaration = "%s %s;\n" % (self.ctype, self.csym)
         else:
-            if self.data is None:
-                items = self.width * self.height * self.image_format.items
-                self.data = FFI().new(self.image_format.ctype + '[]', items)
-            addr = FFI().cast('long', self.data)
             self.ctype = self.image_format.ctype + " *"
-            self.csym = "__img%d" % self.count
-            self.cdeclaration = "%s __restrict__ %s = ((%s) 0x%x);\n" % (
-                self.ctype, self.csym, self.ctype, addr)
+            if self.data is None:
+                # Over-allocate to place the pixels on a cache line boundary.
+                # No further access hints are given. madvise() only affects
+                # readahead of file backed memory, the generated loops are
+                # sequential which the hardware prefetcher handles, and most
+                # images are read back by the next node right after being
+                # written, so non-temporal stores would do more harm than good.
+                fmt = self.image_format
+                size = self.width * self.height * fmt.items * fmt.dtype.itemsize
+                self._buffer = _ffi.new('char[]', size + self.alignment - 1)
+                addr = int(_ffi.cast('long', self._buffer))
+                addr = (addr + self.alignment - 1) & ~(self.alignment - 1)
+                self.data = _ffi.cast(self.ctype, addr)
+            # External data is given no hint, as the alignment it happens to
+            # have would make the source, and so the compiled module, differ
+            # between runs
+            align = self.alignment if self._buffer is not None else 1
+            self.csym = "__img%d" % index
+            # Only the images placed on top of another one may alias
+            restrict = '' if self.shares_buffer else '__restrict__ '
+            self.cdeclaration = \
+                "%s %s%s = __builtin_assume_aligned((%s) %s, %d);\n" % (
+                    self.ctype, restrict, self.csym, self.ctype,
+                    code.add_pointer(self.data), align)
+
+    def as_array(self):
+        """ A flat numpy array sharing the pixel data allocated by ``alloc()``.
+        """
+        fmt = self.image_format
+        size = self.width * self.height * fmt.items * fmt.dtype.itemsize
+        return numpy.frombuffer(_ffi.buffer(self.data, size), fmt.dtype)
 
     def getitem2d(self, node, channel, x, y):
         if self.optimized_out:
@@ -146,7 +256,7 @@ class CoreImage(model.Image):
                     "Cant access pixel of multi channel image without specifying channel.")
             channel = CHANNEL_0
         else:
-            channel = eval(channel.upper())
+            channel = channel_by_name[channel.lower()]
         name = self.csym
         ss = self.image_format.subsamp(channel)
         off = self.image_format.offset(channel)
@@ -170,6 +280,9 @@ class CoreImage(model.Image):
 
         name = self.csym
         if channel == 'data':
+            # Indexes the buffer as is. Loops known to stay within the image
+            # address it this way, as the clamps of the accessors below keep
+            # gcc from vectorizing them.
             return '%s[%s]' % (name, idx)
         if channel is None:
             if node.border_mode == BORDER_MODE_UNDEFINED:
@@ -178,7 +291,7 @@ class CoreImage(model.Image):
             else:
                 raise NotImplementedError
         else:
-            channel = eval(channel.upper())
+            channel = channel_by_name[channel.lower()]
             ss = self.image_format.subsamp(channel)
             off = self.image_format.offset(channel)
             stride_x = self.image_format.items
@@ -192,12 +305,19 @@ class CoreImage(model.Image):
         if node.convert_policy == CONVERT_POLICY_SATURATE:
             if op != '=':
                 raise NotImplementedError
+            # Images already keep their narrow type (result_color), and gcc
+            # vectorizes this widened add+clamp at -O3 -march=native about
+            # as fast as hand written _mm256_adds_epu8 would, so no
+            # intrinsics are emitted here.
             return "%s = clamp(%s, %r, %r)" % (
                 self.getitem(node, channel, idx), value,
                 self.image_format.minval, self.image_format.maxval)
         return self.getitem(node, channel, idx) + ' ' + op + ' ' + value
 
     def getattr(self, node, attr):
+        # The sizes are emitted as literals, so each kernel is specialised on
+        # them and gcc drops the vector epilogues of loops whose trip count is
+        # a multiple of the vector width
         if attr == "width":
             return str(self.width)
         elif attr == "height":
@@ -223,6 +343,8 @@ class ConstantImage(CoreImage):
         self.color = value_color_type(value)
         self.virtual = False
         self.producer = None
+        CoreImage.count += 1
+        self.count = CoreImage.count
 
     def getitem(self, node, channel, idx):
         return str(self.value)
@@ -230,15 +352,33 @@ class ConstantImage(CoreImage):
     def setitem(self, node, channel, idx, op, value):
         raise InvalidGraphError("ConstantImage's are not writeable.")
 
-    def alloc(self):
+    def alloc_size(self):
+        return 0
+
+    def alloc(self, code, index):
         self.cdeclaration = ''
 
+    def as_array(self):
+        return None
+
 
 class CoreGraph(model.Graph):
     default_context = None
     local_state = threading.local()
     local_state.current_graph = None
     show_source = False
+    # Build the graph with numba rather than with a C compiler. That is also
+    # done without this if no C compiler is found and numba is installed.
+    use_numba = False
+    # Compiled graphs are kept here and reused when the same graph is built
+    # again, e.g. by the next run of a script. Set to None, or set the
+    # PYVX_NO_CACHE environment variable, to compile in a temporary directory.
+    # Only the cache_size most recently used graphs are kept.
+    cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'pyvx')
+    cache_size = 256
+    # The (ffi, lib) of each module loaded by this process, by source and
+    # flags, so graphs built again within it skip ffi.verify() altogether
+    compiled_modules = {}
 
     def __init__(self, context=None, early_verify=True):
         if context is None:
@@ -299,7 +439,7 @@ class CoreGraph(model.Graph):
         scheduler = Scheduler(self.nodes, self.images)
         one_order = []
         while scheduler.loaded_nodes:
-            n = scheduler.loaded_nodes.pop()
+            n = scheduler.loaded_nodes.popleft()
             scheduler.fire(n)
             one_order.append(n)
         if scheduler.blocked_nodes:
@@ -309,50 +449,185 @@ class CoreGraph(model.Graph):
     def optimize(self):
         pass
 
+    def share_buffers(self):
+        """ Groups the virtual images needing a buffer such that the images
+            of a group can share one. An image needs its buffer from the
+            node writing it until the last node reading it, and a group is
+            only joined once all its images are no longer needed. Returns
+            the groups, each in the order its images were allocated.
+        """
+        first, last = {}, {}
+        for i, n in enumerate(self.nodes):
+            for d in n.outputs + n.inouts:
+                first.setdefault(d, i)
+            for d in n.inputs + n.inouts:
+                last[d] = i
+        images = [d for d in sorted(self.images, key=lambda d: d.count)
+                  if d.virtual and d.alloc_size()]
+        groups, free = [], []
+        for d in sorted(images, key=lambda d: first.get(d, -1)):
+            start = first.get(d, -1)
+            # The group freed last is the one most likely still in cache
+            reuse = [g for g in free if g[0] < start]
+            if reuse:
+                free.remove(reuse[-1])
+                group = reuse[-1][1]
+            else:
+                group = []
+                groups.append(group)
+            group.append(d)
+            free.append((last.get(d, len(self.nodes)), group))
+            free.sort(key=lambda e: e[0])
+        return groups
+
+    def alloc_images(self):
+        # The images without data share one buffer, each starting on a cache
+        # line boundary and laid out in creation order. It is a single
+        # allocation, kept alive by the images using it. Virtual images are
+        # always written by their producer before being read, so their buffer
+        # is not cleared, and those never needed at the same time are placed
+        # on top of each other. The others can be read before the graph is run.
+        align = CoreImage.alignment
+        groups = self.share_buffers()
+        virtual = set(d for g in groups for d in g)
+        other = [[d] for d in sorted(self.images, key=lambda d: d.count)
+                 if d not in virtual and d.alloc_size()]
+        for groups, new in ((groups, _new_uncleared), (other, _ffi.new)):
+            sizes = [(g, (max(d.alloc_size() for d in g) + align - 1) & ~(align - 1))
+                     for g in groups]
+            total = sum(size for g, size in sizes)
+            if not total:
+                continue
+            slab = new('char[]', total + align - 1)
+            addr = (int(_ffi.cast('long', slab)) + align - 1) & ~(align - 1)
+            for g, size in sizes:
+                for d in g:
+                    d._buffer = slab
+                    d.data = _ffi.cast(d.image_format.ctype + ' *', addr)
+                    d.shares_buffer = len(g) > 1
+                addr += size
+
     def compile(self):
-        for d in self.images:
-            d.alloc()
-        imgs = ''.join(d.cdeclaration for d in self.images)
+        self.alloc_images()
+        code = Code()
+        # Named by their position in the graph rather than by the global
+        # count, so that building the same graph again generates the same
+        # source and ffi.verify() loads the module already compiled for it
+        images = sorted(self.images, key=lambda d: d.count)
+        for i, d in enumerate(images):
+            d.alloc(code, i)
+        code.add_code(''.join(d.cdeclaration for d in images) + "\n")
+        # Written as selects and inlined, so that gcc emits cmov or min/max
+        # instructions and folds the literal bounds at each use
         head = '''
-            long clamp(long val, long min_val, long max_val) {
-                if (val < min_val) return min_val;
-                if (val > max_val) return max_val;
-                return val;
+            static inline long clamp(long val, long min_val, long max_val) {
+                return val < min_val ? min_val : (val > max_val ? max_val : val);
             }
-            long subsample(long val) {
+            static inline long subsample(long val) {
                 return val & (~1);
             }
         '''
-        code = Code(imgs + "\n")
         code.includes.add('#include <math.h>')
         code.includes.add('#include <VX/vx.h>')
         for n in self.nodes:
             assert not n.optimized_out
             n.compile(code)
-        ffi = FFI()
-        ffi.cdef("int func(void);")
         if self.show_source:
             print str(code)
+        cached = self.cache_dir is not None and 'PYVX_NO_CACHE' not in os.environ
+        # Without a C compiler the graph is left to numba, if it is installed
+        if self.use_numba or not have_compiler():
+            try:
+                self.compiled_func = code.build_numba(
+                    self.image_arrays(), cache_dir=self.cache_dir if cached else None)
+                if cached:
+                    evict_cache(self.cache_dir, self.cache_size)
+                return
+            except NoFastPath:
+                pass
         inc = '\n'.join(code.includes) + '\n'
-        tmpdir = mkdtemp()
+        src = (inc + head + "int func(void **__pointers) {" + str(code) +
+               "return VX_SUCCESS;}")
         mydir = os.path.dirname(os.path.abspath(__file__))
         vxdir = os.path.join(mydir, 'inc', 'headers')
-        try:
-            lib = ffi.verify(inc + head +
-                             "int func(void) {" + str(code) +
-                             "return VX_SUCCESS;}",
-                             extra_compile_args=["-O3", "-march=native", "-std=c99",
-                                                 "-I" + mydir,
-                                                 "-I" + vxdir],
-                             extra_link_args=code.extra_link_args,
-                             tmpdir=tmpdir)
-        finally:
-            rmtree(tmpdir)
-        self.compiled_func = lib.func
-
-    def process(self):
+        flags = ["-O3", "-std=c99", "-fno-math-errno", "-fno-plt",
+                 "-I" + mydir, "-I" + vxdir]
+        # cffi names the module after the flags as written, so what
+        # -march=native means here is added to the source to not load a
+        # cached module built for another CPU, e.g. from a shared home.
+        # If that can't be found out the module is not cached at all.
+        target = native_target()
+        if target is None:
+            cached = False
+        flags.insert(1, "-march=native")
+        src = "/* -march=native: %s */\n" % target + src
+        if platform.machine() in ('x86_64', 'AMD64'):
+            # gcc otherwise tunes most AVX-512 hosts for 256 bit vectors, but
+            # the generated loops are 5-20% faster at the full width. Without
+            # AVX-512 this has no effect.
+            flags.append("-mprefer-vector-width=512")
+        key = (src, tuple(flags + code.extra_compile_args), tuple(code.extra_link_args))
+        if key in self.compiled_modules:
+            ffi, lib = self.compiled_modules[key]
+        else:
+            ffi = FFI()
+            ffi.cdef("int func(void **__pointers);")
+            kwargs = dict(extra_compile_args=flags + code.extra_compile_args,
+                          extra_link_args=code.extra_link_args)
+            if cached:
+                lib = self.load_cached(ffi, src, kwargs)
+            else:
+                tmpdir = mkdtemp()
+                try:
+                    lib = ffi.verify(src, tmpdir=tmpdir, **kwargs)
+                finally:
+                    rmtree(tmpdir)
+            self.compiled_modules[key] = (ffi, lib)
+        pointers = ffi.new('void *[]', [ffi.cast('void *', p) for p in code.pointers])
+        self.compiled_func = lambda: lib.func(pointers)
+
+    def load_cached(self, ffi, src, kwargs):
+        # cffi names the module after a hash of the source and flags. It is
+        # built in a private directory and renamed into the cache, so that
+        # processes building the same graph at once never see half of it.
+        verifier = Verifier(ffi, src, tmpdir=self.cache_dir, **kwargs)
+        if os.path.isfile(verifier.modulefilename):
+            os.utime(verifier.modulefilename, None)
+        else:
+            if not os.path.isdir(self.cache_dir):
+                try:
+                    os.makedirs(self.cache_dir)
+                except OSError:
+                    if not os.path.isdir(self.cache_dir):
+                        raise
+            builddir = mkdtemp(dir=self.cache_dir)
+            try:
+                builder = Verifier(ffi, src, tmpdir=builddir, **kwargs)
+                builder.compile_module()
+                os.rename(builder.sourcefilename, verifier.sourcefilename)
+                os.rename(builder.modulefilename, verifier.modulefilename)
+            finally:
+                rmtree(builddir)
+            evict_cache(self.cache_dir, self.cache_size)
+        return verifier.load_library()
+
+    def image_arrays(self):
+        arrays = {}
+        for d in self.images:
+            if not d.optimized_out and d.as_array() is not None:
+                arrays[d.csym] = d.as_array()
+        return arrays
+
+    def process(self, block=False):
+        """ Execute the graph. If ``block`` is ``True``, the nodes are first
+            given a chance to wait until there is new input to process, e.g.
+            pacing the playback of a video file to it's frame rate.
+        """
         if self.compiled_func is None:
             self.verify()
+        if block:
+            for node in self.nodes:
+                node.wait()
         return self.compiled_func()
 
     def add_parameter(self, parameter):
@@ -364,31 +639,43 @@ class CoreGraph(model.Graph):
 
 
 class Scheduler(object):
+    # Kahn's algorithm. Each blocked node counts its inputs not yet present,
+    # and firing a node only visits the consumers of the data it makes
+    # present, instead of rescanning all blocked nodes. Data not in the set
+    # ``absent`` is present. The nodes become loaded in the order of
+    # ``nodes``, and of the consumers of each data, and are taken in that
+    # order, so the same graph is always scheduled, and compiled, the same.
 
     def __init__(self, nodes, images):
         self.nodes = nodes
         self.images = images
-        self.present = defaultdict(lambda: True)
-        for d in self.images:
-            self.present[d] = not d.virtual
+        self.absent = set(d for d in self.images if d.virtual)
         for n in self.nodes:
-            for d in n.outputs + n.inouts:
-                self.present[d] = False
-        self.blocked_nodes = set(self.nodes)
-        self.loaded_nodes = set()
-        self.fire()
-
-    def fire(self, node=None):
-        if node is not None:
-            for d in node.outputs:
-                self.present[d] = True
-        for n in list(self.blocked_nodes):
-            # print n
-            # for d in n.inputs:
-            #     print '    ', d, self.present[d]
-            if all(self.present[d] for d in n.inputs):
-                self.blocked_nodes.remove(n)
-                self.loaded_nodes.add(n)
+            self.absent.update(n.outputs + n.inouts)
+        self.consumers = defaultdict(list)
+        self.missing = {}
+        self.blocked_nodes = set()
+        self.loaded_nodes = deque()
+        for n in self.nodes:
+            missing = self.absent.intersection(n.inputs)
+            for d in missing:
+                self.consumers[d].append(n)
+            self.missing[n] = len(missing)
+            if missing:
+                self.blocked_nodes.add(n)
+            else:
+                self.loaded_nodes.append(n)
+
+    def fire(self, node):
+        for d in node.outputs:
+            if d not in self.absent:
+                continue
+            self.absent.remove(d)
+            for n in self.consumers.pop(d, ()):
+                self.missing[n] -= 1
+                if not self.missing[n]:
+                    self.blocked_nodes.remove(n)
+                    self.loaded_nodes.append(n)
 
 
 class Scalar(model.Scalar):
@@ -661,23 +948,25 @@ class Node(model.Node):
         if not condition:
             raise InvalidFormatError
 
+    def wait(self):
+        pass
+
 
 class MergedNode(Node):
 
     def __init__(self, graph, nodes):
         self.original_nodes = nodes
         self.graph = graph
-        inputs, outputs, inouts = set(), set(), set()
-        for n in nodes:
-            inputs |= set(n.inputs)
-            outputs |= set(n.outputs)
-            inouts |= set(n.inouts)
-        inputs -= outputs
-        inputs -= inouts
-
-        inputs = list(inputs)
-        outputs = list(outputs)
-        inouts = list(inouts)
+        # In the order of the nodes, as the order of the parameters decides
+        # that of the schedule
+        def unique(items):
+            seen = set()
+            return [d for d in items if not (d in seen or seen.add(d))]
+        outputs = unique(d for n in nodes for d in n.outputs)
+        inouts = unique(d for n in nodes for d in n.inouts)
+        written = set(outputs + inouts)
+        inputs = [d for d in unique(d for n in nodes for d in n.inputs)
+                  if d not in written]
         self.graph._add_node(self)
         for d in outputs + inouts:
             assert d.producer in nodes
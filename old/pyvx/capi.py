@@ -27,7 +27,7 @@ from pyvx import __version_info__, __version__
 major, minor, _ = __version_info__
 soversion = '%d.%d' % (major, minor)
 
-builder = CApiBuilder(vx.ffi)
+builder = CApiBuilder(vx.ffi, vx.cdefs, vx.types.verify)
 builder.setup = """
 import sys
 sys.path = ['.'] + sys.path
@@ -36,7 +36,7 @@ if pyvx.__version__ != %r:
     print 'Version mismatch. Please reinstall pyvx and/or recompile your binary. Exiting...'
     exit()
 from pyvx.capi import builder
-builder.load()
+builder.load('openvx')
 """ % __version__
 builder.includes.add('#include <VX/vx.h>')
 
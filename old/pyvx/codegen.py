@@ -9,27 +9,61 @@ from pycparser.c_generator import CGenerator
 from cffi import FFI
 import tempfile
 import subprocess
-import os, re
-from shutil import rmtree, copy
+import os, re, sys
+import imp
+import marshal
+import hashlib
+import numbers
+import keyword
+import math
+import numpy
+from shutil import rmtree
+from multiprocessing.pool import ThreadPool
+from distutils.ccompiler import new_compiler
+from distutils.sysconfig import customize_compiler, get_python_inc, get_config_var
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 typedefs = ''.join("typedef int uint%d_t; typedef int int%d_t;" % (n, n)
                    for n in [8, 16, 32, 64])
+_function_prefix = typedefs + "void f() {"
+
+# Building a CParser generates the PLY tables, so a single instance is shared.
+# The parsed ASTs are cached on the source string as the same node
+# templates are parsed over and over again when graphs are built.
+_parser = c_parser.CParser()
+_cache_size = 512
+_cparse_cache = {}
+_cparse_signature_cache = {}
+_rewriter_pattern_cache = {}
+
+
+def _cached(cache, key, parse):
+    if key not in cache:
+        if len(cache) >= _cache_size:
+            cache.clear()
+        cache[key] = parse()
+    return cache[key]
 
 
 def cparse(code):
-    parser = c_parser.CParser()
-    ast = parser.parse(typedefs + "void f() {" + code + "}")
-    func = ast.ext[-1]
-    # func.show()
-    assert func.decl.name == 'f'
-    return func.body
+    def parse():
+        ast = _parser.parse(''.join((_function_prefix, code, "}")))
+        func = ast.ext[-1]
+        # func.show()
+        assert func.decl.name == 'f'
+        return func.body
+    return _cached(_cparse_cache, code, parse)
 
 
 def cparse_signature(signature):
-    parser = c_parser.CParser()
-    ast = parser.parse(typedefs + signature + ';')
-    ast = ast.ext[-1]
-    return ast
+    def parse():
+        ast = _parser.parse(typedefs + signature + ';')
+        return ast.ext[-1]
+    return _cached(_cparse_signature_cache, signature, parse)
 
 
 class MagicCGenerator(CGenerator):
@@ -84,6 +118,435 @@ class MagicCGenerator(CGenerator):
                            node.op, self.visit(node.rvalue))
 
 
+class NoFastPath(Exception):
+    pass
+
+
+class MagicRewriter(object):
+
+    """ Performs the same magic variable rewrites as ``MagicCGenerator``, but
+        by scanning the code for ``var[...]``, ``var.field[...]`` and ``var.field``
+        instead of parsing it. All other code is passed through unchanged.
+        ``NoFastPath`` is raised for code it can't handle safely.
+    """
+
+    assign_op = re.compile(r'\s*(<<=|>>=|\+=|-=|\*=|/=|%=|&=|\^=|\|=|=(?!=))')
+    brackets = {'(': ')', '[': ']', '{': '}'}
+
+    def __init__(self, cxnode, magic_vars):
+        self.cxnode = cxnode
+        self.magic_vars = magic_vars
+        names = tuple(sorted(magic_vars, key=lambda n: (-len(n), n)))
+        self.pattern = _cached(_rewriter_pattern_cache, names, lambda: re.compile(
+            r'(?<![\w.])(?<!->)(%s)\b(?:\s*\.\s*(\w+))?(\s*\[)?'
+            % '|'.join(re.escape(n) for n in names)))
+
+    def rewrite(self, code):
+        if not self.magic_vars:
+            return code
+        out = []
+        pos = 0
+        while True:
+            m = self.pattern.search(code, pos)
+            if m is None:
+                out.append(code[pos:])
+                return ''.join(out)
+            out.append(code[pos:m.start()])
+            var = self.magic_vars[m.group(1)]
+            channel = m.group(2)
+            if m.group(3) is None:
+                if channel is None:
+                    out.append(m.group(1))
+                else:
+                    out.append(var.getattr(self.cxnode, channel))
+                pos = m.end()
+                continue
+            end = self.expression_end(code, m.end(), stop='')
+            if end >= len(code) or code[end] != ']':
+                raise NoFastPath
+            index = self.split_index(self.rewrite(code[m.end():end]))
+            pos = end + 1
+            assign = self.assign_op.match(code, pos)
+            if assign:
+                end = self.expression_end(code, assign.end())
+                value = self.rewrite(code[assign.end():end]).strip()
+                out.append(var.setitem(self.cxnode, channel, index,
+                                       assign.group(1), value))
+                pos = end
+            else:
+                out.append(var.getitem(self.cxnode, channel, index))
+
+    def expression_end(self, code, pos, stop=';,'):
+        """ Returns the position of the first character in ``stop`` outside of
+            any brackets, or of the first closing bracket not opened after ``pos``.
+        """
+        stack = []
+        for i in xrange(pos, len(code)):
+            c = code[i]
+            if c in self.brackets:
+                stack.append(self.brackets[c])
+            elif c in ')]}':
+                if not stack:
+                    return i
+                if stack.pop() != c:
+                    raise NoFastPath
+            elif c in stop and not stack:
+                return i
+        if stack:
+            raise NoFastPath
+        return len(code)
+
+    def split_index(self, index):
+        parts = []
+        pos = 0
+        while pos <= len(index):
+            end = self.expression_end(index, pos)
+            if end < len(index) and index[end] != ',':
+                raise NoFastPath
+            parts.append(index[pos:end].strip())
+            pos = end + 1
+        if len(parts) == 1:
+            return parts[0]
+        if len(parts) == 2:
+            return tuple(parts)
+        raise NoFastPath
+
+
+def clamp(val, min_val, max_val):
+    val = int(val)
+    if val < min_val:
+        return min_val
+    if val > max_val:
+        return max_val
+    return val
+
+
+def subsample(val):
+    return int(val) & (~1)
+
+
+def cdiv(a, b):
+    if isinstance(a, numbers.Integral) and isinstance(b, numbers.Integral):
+        q = abs(a) // abs(b)
+        if (a < 0) != (b < 0):
+            return -q
+        return q
+    return a / b
+
+
+def cmod(a, b):
+    return a - b * cdiv(a, b)
+
+
+# Generated python code is run with the same semantics as the C-code with these
+numba_globals = {'math': math, 'numpy': numpy, 'prange': range,
+                 'clamp': clamp, 'subsample': subsample,
+                 'cdiv': cdiv, 'cmod': cmod}
+
+if numba is not None:
+    @numba.generated_jit(nopython=True)
+    def _numba_cdiv(a, b):
+        if isinstance(a, numba.types.Integer) and isinstance(b, numba.types.Integer):
+            def div(a, b):
+                q = abs(a) // abs(b)
+                if (a < 0) != (b < 0):
+                    return -q
+                return q
+            return div
+        return lambda a, b: a / b
+
+    numba_jit_globals = dict(numba_globals)
+    numba_jit_globals.update(prange=numba.prange,
+                             clamp=numba.njit(clamp),
+                             subsample=numba.njit(subsample),
+                             cdiv=_numba_cdiv)
+    numba_jit_globals['cmod'] = numba.njit(
+        lambda a, b: a - b * _numba_cdiv(a, b))
+
+
+class NumbaCGenerator(c_ast.NodeVisitor):
+
+    """ Translates generated C-code (with the magic variables already
+        rewritten) into the body of a python function suitable for numba.
+        The images are passed as the flat numpy arrays ``arrays``, keyed on
+        their C symbols, and declarations of pointers to them are dropped.
+        ``NoFastPath`` is raised for constructs it can't translate.
+    """
+
+    functions = {'sqrt': 'math.sqrt', 'atan2': 'math.atan2', 'pow': 'math.pow',
+                 'floor': 'math.floor', 'floorf': 'numpy.floor',
+                 'ceil': 'math.ceil', 'fabs': 'math.fabs', 'abs': 'abs',
+                 'labs': 'abs', 'exp': 'math.exp',
+                 'log': 'math.log', 'sin': 'math.sin', 'cos': 'math.cos',
+                 'rint': 'numpy.rint', 'clamp': 'clamp', 'subsample': 'subsample'}
+    constants = {'M_PI': 'math.pi'}
+    operators = {'&&': 'and', '||': 'or', '!': 'not '}
+    float_types = ('float', 'double')
+    # Casts making assignments wrap around as they do in C
+    types = dict(('%sint%d_t' % (u, n), 'numpy.%sint%d' % (u, n))
+                 for u in ('', 'u') for n in (8, 16, 32, 64))
+    types['float'] = 'numpy.float32'
+    array_dtypes = {'int': 'numpy.int64', 'float': 'numpy.float64'}
+
+    def __init__(self, arrays, parallel=True):
+        self.arrays = arrays
+        self.parallel = parallel
+        self.scopes = [{}]
+        self.used_names = set(arrays)
+        self.lines = []
+        self.indent_level = 1
+        self.loop_depth = 0
+        self.local_arrays = set()
+
+    def emit(self, line):
+        self.lines.append('    ' * self.indent_level + line)
+
+    def name(self, name):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name][0]
+        if name in self.constants:
+            return self.constants[name]
+        return name
+
+    def declare(self, name, cast):
+        # Python has no block scopes, so shadowed C variables are renamed
+        pyname = name
+        if keyword.iskeyword(pyname):
+            pyname += '_'
+        i = 0
+        while pyname in self.used_names:
+            i += 1
+            pyname = '%s_%d' % (name, i)
+        self.used_names.add(pyname)
+        self.scopes[-1][name] = (pyname, cast)
+        return pyname
+
+    def cast(self, type_node):
+        if not isinstance(type_node, c_ast.TypeDecl) or \
+           not isinstance(type_node.type, c_ast.IdentifierType):
+            raise NoFastPath
+        names = type_node.type.names
+        if len(names) == 1 and names[0] in self.types:
+            return self.types[names[0]]
+        if 'double' in names:
+            return 'float'
+        return 'int'
+
+    def generic_visit(self, node):
+        raise NoFastPath
+
+    def block(self, node):
+        self.indent_level += 1
+        self.scopes.append({})
+        n = len(self.lines)
+        if isinstance(node, c_ast.Compound):
+            for stmt in node.block_items or ():
+                self.statement(stmt)
+        else:
+            self.statement(node)
+        if len(self.lines) == n:
+            self.emit('pass')
+        self.scopes.pop()
+        self.indent_level -= 1
+
+    def statement(self, node):
+        if isinstance(node, c_ast.Compound):
+            self.scopes.append({})
+            for stmt in node.block_items or ():
+                self.statement(stmt)
+            self.scopes.pop()
+        elif isinstance(node, c_ast.DeclList):
+            for decl in node.decls:
+                self.statement(decl)
+        elif isinstance(node, c_ast.Decl):
+            self.declaration(node)
+        elif isinstance(node, c_ast.Assignment):
+            self.emit(self.assignment(node))
+        elif isinstance(node, c_ast.UnaryOp) and node.op in ('p++', '++', 'p--', '--'):
+            self.emit('%s %s= 1' % (self.visit(node.expr), node.op[-1]))
+        elif isinstance(node, c_ast.For):
+            self.for_loop(node)
+        elif isinstance(node, c_ast.While):
+            self.emit('while %s:' % self.visit(node.cond))
+            self.loop_depth += 1
+            self.block(node.stmt)
+            self.loop_depth -= 1
+        elif isinstance(node, c_ast.If):
+            self.emit('if %s:' % self.visit(node.cond))
+            self.block(node.iftrue)
+            if node.iffalse is not None:
+                self.emit('else:')
+                self.block(node.iffalse)
+        elif isinstance(node, (c_ast.EmptyStatement, c_ast.Pragma)):
+            pass
+        elif isinstance(node, c_ast.FuncCall):
+            self.emit(self.visit(node))
+        else:
+            raise NoFastPath
+
+    def declaration(self, node):
+        if isinstance(node.type, c_ast.PtrDecl):
+            target = node.init
+            if isinstance(target, c_ast.Cast):
+                target = target.expr
+            if isinstance(target, c_ast.FuncCall) and target.args and \
+               target.name.name == '__builtin_assume_aligned':
+                target = target.args.exprs[0]
+            if node.name in self.arrays and target is not None:
+                return
+            if isinstance(target, c_ast.ID) and self.name(target.name) in self.arrays:
+                self.emit('%s = %s' % (self.declare(node.name, None),
+                                       self.name(target.name)))
+                return
+            raise NoFastPath
+        if isinstance(node.type, c_ast.ArrayDecl):
+            if node.init is not None or node.type.dim is None:
+                raise NoFastPath
+            # numba only takes numpy types as dtypes
+            cast = self.cast(node.type.type)
+            cast = self.array_dtypes.get(cast, cast)
+            name = self.declare(node.name, None)
+            self.local_arrays.add(name)
+            self.emit('%s = numpy.zeros(%s, %s)' % (name, self.visit(node.type.dim), cast))
+            return
+        cast = self.cast(node.type)
+        if node.init is None:
+            value = '%s(0)' % cast
+        else:
+            value = '%s(%s)' % (cast, self.visit(node.init))
+        self.emit('%s = %s' % (self.declare(node.name, cast), value))
+
+    def assignment(self, node):
+        value = self.visit(node.rvalue)
+        if isinstance(node.lvalue, c_ast.ID):
+            for scope in reversed(self.scopes):
+                if node.lvalue.name in scope:
+                    # Keep the type of locals, as C converts on assignment
+                    pyname, cast = scope[node.lvalue.name]
+                    if cast and node.op == '=':
+                        value = '%s(%s)' % (cast, value)
+                    break
+        elif not isinstance(node.lvalue, c_ast.ArrayRef):
+            raise NoFastPath
+        if node.op in ('/=', '%='):
+            lvalue = self.visit(node.lvalue)
+            fn = 'cdiv' if node.op == '/=' else 'cmod'
+            return '%s = %s(%s, %s)' % (lvalue, fn, lvalue, value)
+        return '%s %s %s' % (self.visit(node.lvalue), node.op, value)
+
+    def for_loop(self, node):
+        # Counting loops declaring their counter are turned into range()
+        # loops, where the outermost ones are parallelized
+        var = None
+        if isinstance(node.init, c_ast.DeclList) and len(node.init.decls) == 1 and \
+           isinstance(node.cond, c_ast.BinaryOp) and node.cond.op in ('<', '<=') and \
+           isinstance(node.cond.left, c_ast.ID) and \
+           isinstance(node.next, c_ast.UnaryOp) and node.next.op in ('p++', '++'):
+            decl = node.init.decls[0]
+            if decl.init is not None and decl.name == node.cond.left.name and \
+               isinstance(node.next.expr, c_ast.ID) and \
+               node.next.expr.name == decl.name and \
+               not self.assigns(node.stmt, decl.name):
+                var = decl
+        self.scopes.append({})
+        if var is None:
+            if node.init is not None:
+                self.statement(node.init)
+            self.emit('while %s:' % (self.visit(node.cond) if node.cond else 'True'))
+            self.loop_depth += 1
+            self.block(node.stmt)
+            if node.next is not None:
+                self.indent_level += 1
+                self.statement(node.next)
+                self.indent_level -= 1
+        else:
+            start = self.visit(var.init)
+            stop = self.visit(node.cond.right)
+            if node.cond.op == '<=':
+                stop = '(%s) + 1' % stop
+            # Local arrays, like the row buffers of separable filters, are
+            # carried between the iterations
+            if self.parallel and self.loop_depth == 0 and \
+               not self.uses_local_array(node.stmt):
+                loop = 'prange'
+            else:
+                loop = 'range'
+            name = self.declare(var.name, None)
+            self.emit('for %s in %s(%s, %s):' % (name, loop, start, stop))
+            self.loop_depth += 1
+            self.block(node.stmt)
+        self.loop_depth -= 1
+        self.scopes.pop()
+
+    def assigns(self, node, name):
+        for child in node.children():
+            child = child[1]
+            if isinstance(child, c_ast.Assignment) and \
+               isinstance(child.lvalue, c_ast.ID) and child.lvalue.name == name:
+                return True
+            if isinstance(child, c_ast.UnaryOp) and \
+               child.op in ('p++', '++', 'p--', '--') and \
+               isinstance(child.expr, c_ast.ID) and child.expr.name == name:
+                return True
+            if self.assigns(child, name):
+                return True
+        return False
+
+    def uses_local_array(self, node):
+        for _, child in node.children():
+            if isinstance(child, c_ast.ArrayRef) and isinstance(child.name, c_ast.ID) and \
+               self.name(child.name.name) in self.local_arrays:
+                return True
+            if self.uses_local_array(child):
+                return True
+        return False
+
+    def visit_ID(self, node):
+        return self.name(node.name)
+
+    def visit_Constant(self, node):
+        if node.type == 'int':
+            return node.value.rstrip('uUlL')
+        if node.type in self.float_types:
+            return node.value.rstrip('fFlL')
+        raise NoFastPath
+
+    def visit_BinaryOp(self, node):
+        left, right = self.visit(node.left), self.visit(node.right)
+        if node.op == '/':
+            return 'cdiv(%s, %s)' % (left, right)
+        if node.op == '%':
+            return 'cmod(%s, %s)' % (left, right)
+        return '(%s %s %s)' % (left, self.operators.get(node.op, node.op), right)
+
+    def visit_UnaryOp(self, node):
+        if node.op not in ('-', '+', '~', '!'):
+            raise NoFastPath
+        return '(%s%s)' % (self.operators.get(node.op, node.op), self.visit(node.expr))
+
+    def visit_TernaryOp(self, node):
+        return '(%s if %s else %s)' % (self.visit(node.iftrue), self.visit(node.cond),
+                                       self.visit(node.iffalse))
+
+    def visit_Cast(self, node):
+        return '%s(%s)' % (self.cast(node.to_type.type), self.visit(node.expr))
+
+    def visit_FuncCall(self, node):
+        if not isinstance(node.name, c_ast.ID) or node.name.name not in self.functions:
+            raise NoFastPath
+        args = node.args.exprs if node.args is not None else ()
+        return '%s(%s)' % (self.functions[node.name.name],
+                           ', '.join(self.visit(a) for a in args))
+
+    def visit_ArrayRef(self, node):
+        if not isinstance(node.name, c_ast.ID) or \
+           self.name(node.name.name) not in self.arrays and \
+           self.name(node.name.name) not in self.local_arrays:
+            raise NoFastPath
+        return '%s[%s]' % (self.name(node.name.name), self.visit(node.subscript))
+
+
 class Code(object):
 
     """ 
@@ -96,26 +559,42 @@ class Code(object):
             A ``list`` of extra arguments needed to be passed to the linker when 
             compiling the code. It is typically used to link with external libraries 
             used by the code.
+        ``extra_compile_args``
+            A ``list`` of extra arguments passed to the compiler, e.g. to 
+            enable OpenMP for ``#pragma omp`` annotated loops.
         ``includes``
             A ``set`` of lines added at the top of the generated .c file outside
             the function enclosing the code. This is intended for ``#include ...``
             lines.
+        ``fast_rewrite``
+            If ``False``, the code passed to ``add_block`` is always parsed by
+            pycparser instead of first trying the ``MagicRewriter``.
+        ``pointers``
+            A ``list`` of the cdata pointers registered by ``add_pointer``, in
+            the order they are passed to the compiled function.
 
     """
 
+    fast_rewrite = True
+    numba_kernels = {}
+
     def __init__(self, code=''):
         """ Construct a new ``Code`` object and initiate it's code to ``code``.            
         """
         self.code = code
         self.indent_level = 0
         self.extra_link_args = []
+        self.extra_compile_args = []
         self.includes = set()
+        self.pointers = []
 
     def add_block(self, cxnode, code, **magic_vars):
         """ Append ``code`` as a new block of code. It will be enclosed in with ``{}``
             brackets to allow it to declare local variables. The code will be
-            parsed and all references to the symbol names passed as keyword 
-            arguments will be extracted and handled separately. These magic variables
+            scanned and all references to the symbol names passed as keyword 
+            arguments will be extracted and handled separately. If the code is
+            too complicated for the ``MagicRewriter``, it is parsed with pycparser
+            and handled by the ``MagicCGenerator`` instead. These magic variables
             are intended to refere to ``Image`` objects, but could be anything that define 
             compatible ``getattr()`` and ``getitem()`` methods. If an ``Image`` is
             passed as the keyword argument ``img``, it can be used in the C-code in 
@@ -142,26 +621,130 @@ class Code(object):
                 ``img.data``
                     A pointer to the beginning of the pixel data.
 
+            The channels of multi channel images are stored interleaved, i.e.
+            ``img.channel_x[i]`` refers to ``img.data[i * channels + offset_x]``,
+            where the number of channels and their offsets are given by the
+            ``ImageFormat``. That is the layout of the ``vx_imagepatch_addressing_t``
+            exposed by the api, of user provided buffers and of the frames
+            decoded by ``PlayNode`` and shown by ``ShowNode``, so converting to
+            planar storage would cost a copy at every such boundary.
+
 
         """
-        ast = cparse(code)
-        # ast.show()
-        generator = MagicCGenerator(cxnode, magic_vars)
-        generator.indent_level = self.indent_level
-        hdr = '\n%s// %s\n' % (' ' * self.indent_level,
-                               cxnode.__class__.__name__)
-        self.code += hdr + generator.visit(ast)
+        indent = ' ' * self.indent_level
+        hdr = '\n%s// %s\n' % (indent, cxnode.__class__.__name__)
+        try:
+            if not self.fast_rewrite:
+                raise NoFastPath
+            block = '%s{\n%s\n%s}\n' % (
+                indent, MagicRewriter(cxnode, magic_vars).rewrite(code), indent)
+        except NoFastPath:
+            # The generator only reads the AST, so the cached one can be shared
+            ast = cparse(code)
+            # ast.show()
+            generator = MagicCGenerator(cxnode, magic_vars)
+            generator.indent_level = self.indent_level
+            block = generator.visit(ast)
+        self.code += hdr + block
 
     def add_code(self, code):
         """ Extend the code with ``code`` without any adjustment.
         """
         self.code += code
 
+    def add_pointer(self, ptr):
+        """ Pass the cdata pointer ``ptr`` to the compiled function at runtime
+            and return a ``void *`` C expression refering to it. Keeping the
+            addresses out of the source allows the compiled code to be reused
+            by a later run building the same graph.
+        """
+        self.pointers.append(ptr)
+        return '__pointers[%d]' % (len(self.pointers) - 1)
+
+    def enable_openmp(self):
+        """ Compile and link with ``-fopenmp``, for code using ``#pragma omp``.
+        """
+        for flags in (self.extra_compile_args, self.extra_link_args):
+            if '-fopenmp' not in flags:
+                flags.append('-fopenmp')
+
     def __str__(self):
         """ Returns the generated code.
         """
         return self.code
 
+    def numba_source(self, arrays, parallel=True):
+        """ Translate the generated code into the source of a python function
+            ``kernel`` taking the numpy arrays of ``arrays``, a ``dict``
+            mapping C symbols to arrays, as arguments in sorted order. See
+            ``NumbaCGenerator``.
+        """
+        code = re.sub(r'//[^\n]*', '', self.code).replace('__restrict__', '')
+        try:
+            ast = _parser.parse(''.join((_function_prefix, code, "}")))
+        except c_parser.ParseError:
+            raise NoFastPath
+        generator = NumbaCGenerator(arrays, parallel)
+        generator.statement(ast.ext[-1].body)
+        return 'def kernel(%s):\n%s\n    return 0\n' % (
+            ', '.join(sorted(arrays)), '\n'.join(generator.lines))
+
+    def build_numba(self, arrays, parallel=True, jit=True, cache_dir=None):
+        """ Compile the generated code with numba instead of a C compiler
+            and return a function without arguments executing it on
+            ``arrays``. If ``jit`` is ``False`` the python code is executed
+            without being compiled, which is slow. ``NoFastPath`` is raised
+            if numba is not installed or the code can't be translated. The
+            compiled kernels are kept in ``Code.numba_kernels`` for the
+            lifetime of the process. If ``cache_dir`` is given, the kernel
+            source is written there and numba caches the compiled kernel
+            next to it, so later processes building the same graph load it
+            instead of compiling it again.
+        """
+        if jit and numba is None:
+            raise NoFastPath
+        src = self.numba_source(arrays, parallel and jit)
+        args = [arrays[n] for n in sorted(arrays)]
+        if jit:
+            # Kernels only depend on their source and argument types, so
+            # verifying an unchanged graph again reuses the compiled one
+            signature = numba.int64(*[numba.typeof(a) for a in args])
+            key = (src, parallel, signature)
+            if key not in self.numba_kernels:
+                env = dict(numba_jit_globals)
+                filename = '<kernel>'
+                if cache_dir is not None:
+                    # numba only caches functions defined in an importable
+                    # module backed by a source file
+                    name = 'kernel_%s' % hashlib.sha1(src).hexdigest()
+                    filename = os.path.join(cache_dir, name + '.py')
+                    if not os.path.exists(filename):
+                        if not os.path.isdir(cache_dir):
+                            os.makedirs(cache_dir)
+                        fd, tmp = tempfile.mkstemp(dir=cache_dir)
+                        with os.fdopen(fd, 'w') as f:
+                            f.write(src)
+                        os.rename(tmp, filename)
+                    else:
+                        os.utime(filename, None)
+                    module = sys.modules.setdefault(
+                        'pyvx.' + name, imp.new_module('pyvx.' + name))
+                    module.__file__ = filename
+                    module.__dict__.update(env)
+                    env = module.__dict__
+                exec compile(src, filename, 'exec') in env
+                # The loops of consecutive nodes must not be fused, as numba
+                # can't tell that a stencil reads what the loop before it writes
+                self.numba_kernels[key] = numba.njit(
+                    signature, parallel=parallel and {'fusion': False},
+                    fastmath=True, cache=cache_dir is not None)(env['kernel'])
+            kernel = self.numba_kernels[key]
+        else:
+            env = dict(numba_globals)
+            exec compile(src, '<kernel>', 'exec') in env
+            kernel = env['kernel']
+        return lambda: kernel(*args)
+
 
 def export(signature, add_ret_to_arg=None, retrive_args=True, store_result=True,
            exception_return=-1):
@@ -174,112 +757,191 @@ def export(signature, add_ret_to_arg=None, retrive_args=True, store_result=True,
         return staticmethod(f)
     return decorator
 
+_function_name = re.compile(r'^\s*[^\s]+\s*\*?\s*([^\(\s]+)\s*\(') # XXX: use parser
+
+
 class CApiBuilder(object):
-    def __init__(self, ffi):
+
+    """ Builds a shared library exporting the C functions added with
+        ``add_function`` and implementing them in python. The library embeds
+        python and is compiled as an out-of-line API-mode cffi extension. The
+        python implementations are attached to its ``extern "Python+C"``
+        functions by ``load()``, which should be called from the ``setup``
+        code run when the library is loaded.
+
+        ``ffi`` is used to analyse the signatures and ``type_cdefs`` and
+        ``type_source`` are the cdef declarations and extra C source needed
+        to declare the same types in the extension module.
+    """
+
+    def __init__(self, ffi, type_cdefs=(), type_source=''):
         self.ffi = ffi
+        self.type_cdefs = list(type_cdefs)
+        self.type_source = type_source
         self.cdef = []
-        self.stubs = []
         self.callbacks = {}
         self.wrapped_reference_types = set()
         self.exception_return_values = {}
         self.includes = set()
+        self._typeof_cache = {}
+        self._getctype_cache = {}
+
+    def typeof(self, cdecl):
+        tp = self._typeof_cache.get(cdecl)
+        if tp is None:
+            tp = self.ffi._typeof(cdecl, consider_function_as_funcptr=True)
+            self._typeof_cache[cdecl] = tp
+        return tp
+
+    def getctype(self, tp, replace_with=''):
+        # Parsing the generated declarations is slow in cffi, and the same
+        # (type, name) pairs are looked up for every function of the api
+        key = (tp, replace_with)
+        ctype = self._getctype_cache.get(key)
+        if ctype is None:
+            ctype = self.ffi.getctype(tp, replace_with)
+            self._getctype_cache[key] = ctype
+        return ctype
 
     def add_wrapped_reference_type(self, ctype):
         self.wrapped_reference_types.add(self.ffi.typeof(ctype))
 
     def add_function(self, cdecl, method):
-        tp = self.ffi._typeof(cdecl, 
-                              consider_function_as_funcptr=True)
-        n = re.search(r'^\s*[^\s]+\s*\*?\s*([^\(\s]+)\s*\(', cdecl).group(1) # XXX: use parser
-        callback_var = self.ffi.getctype(tp, '_' + n)
-        callback_var = callback_var.replace('()', '(void)')
-        self.cdef.append("%s;" % callback_var)
-        args = ', '.join(self.ffi.getctype(t, 'a%d' % i)
-                         for i, t in enumerate(tp.args))
-        stub = self.ffi.getctype(tp.result, '%s(%s)' % (n, args))
-        args = ', '.join('a%d' % i for i in xrange(len(tp.args)))
-        if tp.result == 'void':
-            stub += '{_%s(%s);}' % (n, args)
-        else:
-            stub += '{return _%s(%s);}' % (n, args)
-        self.stubs.append(stub)
+        tp = self.typeof(cdecl)
+        n = _function_name.search(cdecl).group(1)
+        # The exported function itself is implemented by cffi as a call into
+        # python, so no C stub or indirection is needed
+        args = ', '.join([self.getctype(t) for t in tp.args]) or 'void'
+        self.cdef.append('extern "Python+C" %s;' %
+                         self.getctype(tp.result, '%s(%s)' % (n, args)))
         self.callbacks[n] = self.make_callback(tp, method)
 
     def make_callback(self, tp, fn):
+        # The marshalling is unrolled into python source specialised for the
+        # signature, so that a call only does the conversions it needs.
         store_result = tp.result in self.wrapped_reference_types
-        retrive_refs = tuple([i for i, a in enumerate(tp.args)
-                              if a in self.wrapped_reference_types])
-        exception_return = self.exception_return_values.get(tp.result, 0)
-
-        def f(*args):
-            args = list(args)
-            try:
-                for i in retrive_refs:
-                    args[i] = self.ffi.from_handle(self.ffi.cast('void *', args[i]))
-                r = fn(*args)
-                if store_result:
-                    r = r.new_handle()
-            except Exception as e:
-                return self.exception_handler(e, tp.result)
-            return r
+        args = ['a%d' % i for i in xrange(len(tp.args))]
+        body = ['a%d = _from_handle(_cast("void *", a%d))' % (i, i)
+                for i, a in enumerate(tp.args)
+                if a in self.wrapped_reference_types]
+        call = 'fn(%s)' % ', '.join(args)
+        if store_result:
+            call += '.new_handle()'
+        body.append('return ' + call)
+        src = 'def f(%s):\n    try:\n%s\n' \
+              '    except Exception as e:\n' \
+              '        return _builder.exception_handler(e, _result)\n' % (
+                  ', '.join(args), '\n'.join('        ' + l for l in body))
+        env = {'fn': fn, '_result': tp.result, '_builder': self,
+               '_from_handle': self.ffi.from_handle, '_cast': self.ffi.cast}
+        exec src in env
+        f = env['f']
         f.__name__ = fn.__name__
-        return self.ffi.callback(tp, f)
+        return f
 
     def build(self, name, version, soversion, out_path):
-        setup = '\n'.join('"%s\\n"' % l for l in self.setup.split('\n'))
-        tmp = tempfile.mkdtemp()
-        try:
-            src = os.path.join(tmp, "tmp.c")
-            with open(src, 'w') as fd:
-                fd.write("""
+        # The setup code is compiled here and embedded marshalled so that it
+        # does not have to be parsed on every load of the library
+        setup = marshal.dumps(compile(self.setup, '<setup>', 'exec'))
+        setup = ', '.join('0x%02x' % ord(c) for c in setup)
+        module = '_lib' + name
+        ffi = FFI()
+        for cdef in self.type_cdefs:
+            ffi.cdef(cdef)
+        ffi.cdef('\n'.join(self.cdef))
+        mydir = os.path.dirname(os.path.abspath(__file__))
+        d = os.path.join(mydir, 'inc', 'headers')
+        # The wrappers are only glue, so there is no -march=native or
+        # -ffast-math, and -fvisibility=hidden would hide the exported api
+        flags = {'extra_compile_args': ["-O3", "-fno-plt", "-flto", "-I" + d],
+                 'extra_link_args': ['-O3', '-flto', '-lpython2.7',
+                                     '-Wl,-soname,lib%s.so.' % name + soversion]}
+        ffi.set_source(module,
+                       '\n'.join(self.includes) + "\n" + self.type_source + """
                     #include <stdint.h>
-                    #include <Python.h>
+                    #include <marshal.h>
+
+                    #if PY_MAJOR_VERSION >= 3
+                    PyMODINIT_FUNC PyInit_%(module)s(void);
+                    #define __init_module PyInit_%(module)s
+                    #else
+                    PyMODINIT_FUNC init%(module)s(void);
+                    #define __init_module init%(module)s
+                    #endif
+
+                    static const char __setup[] = {%(setup)s};
 
                     static void __initialize(void) __attribute__((constructor));
                     void __initialize(void) {
+                      PyObject *co, *d, *r = NULL;
+                      PyImport_AppendInittab("%(module)s", __init_module);
                       Py_Initialize();
-                      PyEval_InitThreads();                  
-                      PyRun_SimpleString(%s);
+                      PyEval_InitThreads();
+                      d = PyModule_GetDict(PyImport_AddModule("__main__"));
+                      co = PyMarshal_ReadObjectFromString((char *) __setup,
+                                                          sizeof(__setup));
+                      if (co)
+                        r = PyEval_EvalCode((void *) co, d, d);
+                      if (!r)
+                        PyErr_Print();
+                      Py_XDECREF(r);
+                      Py_XDECREF(co);
                     }
 
                     static void __deinitialize(void) __attribute__((destructor));
                     void __deinitialize(void) {
                       Py_Finalize();
                     }
-                    """ % setup +
-                         '\n'.join(self.includes) + "\n\n" +
-                         '\n'.join(self.cdef) + "\n\n" + 
-                         '\n'.join(self.stubs))
-
-            from distutils.core import Extension
-            from cffi.ffiplatform import compile
-            mydir = os.path.dirname(os.path.abspath(__file__))
-            d = os.path.join(mydir, 'inc', 'headers')
-            fn = compile(tmp, Extension(name='lib' + name,
-                                        sources=[src],
-                                        extra_compile_args=["-I" + d],
-                                        extra_link_args=['-lpython2.7',
-                                                         '-Wl,-soname,lib%s.so.' % name + soversion]))
-            bfn = os.path.join(out_path, os.path.basename(fn))
-            full = bfn + '.' + version
+                    """ % {'module': module, 'setup': setup})
+        # Building next to the output allows it to be renamed into place
+        tmp = tempfile.mkdtemp(dir=out_path)
+        try:
+            sources = [os.path.join(tmp, module + '.c')]
+            ffi.emit_c_code(sources[0])
+
+            # The library is named after a hash of the generated source and
+            # only recompiled if that source has changed since the last build
+            h = hashlib.sha256(repr(sorted(flags.items())))
+            for fn in sources:
+                with open(fn) as fd:
+                    h.update(fd.read())
+            bfn = os.path.join(out_path, 'lib%s.so' % name)
+            full = bfn + '.' + version + '.' + h.hexdigest()[:16]
             so = bfn + '.' + soversion
-            for f in [full, so, bfn]:
-                try:
-                    os.unlink(f)
-                except OSError:
-                    pass
-            copy(fn, full)
-            os.symlink(os.path.basename(full), so)
-            os.symlink(os.path.basename(full), bfn)
+            if not os.path.exists(full):
+                fn = os.path.join(tmp, 'lib%s.so' % name)
+                self.compile_library(sources, fn, **flags)
+                os.rename(fn, full)
+            # The links are replaced atomically so loaders never miss them
+            for f in [so, bfn]:
+                link = os.path.join(tmp, os.path.basename(f))
+                os.symlink(os.path.basename(full), link)
+                os.rename(link, f)
         finally:
             rmtree(tmp)
         self.library_names = [full, so, bfn]
 
-    def load(self):
-        ffi = FFI()
-        ffi.include(self.ffi)
-        ffi.cdef('\n'.join(self.cdef))
-        lib = ffi.dlopen(None)
+    def compile_library(self, sources, target, extra_compile_args=(),
+                        extra_link_args=()):
+        def compile_source(source):
+            compiler = new_compiler()
+            customize_compiler(compiler)
+            return compiler.compile([source], output_dir=os.path.dirname(target),
+                                    include_dirs=[get_python_inc()],
+                                    extra_postargs=list(extra_compile_args))[0]
+        pool = ThreadPool(len(sources))
+        try:
+            objects = pool.map(compile_source, sources)
+        finally:
+            pool.close()
+        compiler = new_compiler()
+        customize_compiler(compiler)
+        compiler.link_shared_object(objects, target,
+                                    library_dirs=[get_config_var('LIBDIR')],
+                                    extra_postargs=list(extra_link_args))
+
+    def load(self, name):
+        module = __import__('_lib' + name)
         for n, cb in self.callbacks.items():
-            setattr(lib, '_' + n, cb)
-        self.lib = lib
+            module.ffi.def_extern(n)(cb)
+        self.lib = module.lib
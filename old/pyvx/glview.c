@@ -82,6 +82,17 @@ struct glview *glview_create(int width, int height, int pixel_type, int pixel_si
     );
   glBindTexture(GL_TEXTURE_RECTANGLE_NV, 0);
   m->tex=tex;
+
+  /* Frames are uploaded through two pixel buffer objects used in turn, see
+     glview_next */
+  m->size = (size_t) width * height * (pixel_type == GL_RGB ? 3 : 1);
+  glGenBuffers(2, m->pbo);
+  for (int i=0; i<2; i++) {
+    glBindBuffer(GL_PIXEL_UNPACK_BUFFER, m->pbo[i]);
+    glBufferData(GL_PIXEL_UNPACK_BUFFER, m->size, NULL, GL_STREAM_DRAW);
+  }
+  glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0);
+  m->pbo_index = 0;
   glutKeyboardFunc(keyboard);
   glutReshapeFunc(reshape); 
 
@@ -91,9 +102,26 @@ struct glview *glview_create(int width, int height, int pixel_type, int pixel_si
 int glview_next(struct glview *m, unsigned char *imageData) {
   glutSetWindow(m->win);
   glBindTexture(GL_TEXTURE_RECTANGLE_NV, m->tex);
+
+  /* The texture is updated from the buffer filled by the previous call,
+     which the driver can DMA without waiting for, while this frame is copied
+     into the other one. The window thus shows frames one call late. */
+  int i = m->pbo_index;
+  m->pbo_index ^= 1;
+  glBindBuffer(GL_PIXEL_UNPACK_BUFFER, m->pbo[i]);
   glTexSubImage2D(GL_TEXTURE_RECTANGLE_NV,0,
       0,0,m->width,m->height,
-      m->pixel_type, m->pixel_size, imageData);
+      m->pixel_type, m->pixel_size, 0);
+
+  glBindBuffer(GL_PIXEL_UNPACK_BUFFER, m->pbo[m->pbo_index]);
+  /* Orphan the old storage so mapping does not stall on a pending upload */
+  glBufferData(GL_PIXEL_UNPACK_BUFFER, m->size, NULL, GL_STREAM_DRAW);
+  void *dst = glMapBuffer(GL_PIXEL_UNPACK_BUFFER, GL_WRITE_ONLY);
+  if (dst) {
+    memcpy(dst, imageData, m->size);
+    glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER);
+  }
+  glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0);
   glClearColor(0.0, 0.0, 0.0, 1.0);
   glClear(GL_COLOR_BUFFER_BIT);
 
@@ -114,5 +142,9 @@ int glview_next(struct glview *m, unsigned char *imageData) {
 }
 
 void glview_release(struct glview *m) {
+  glutSetWindow(m->win);
+  glDeleteBuffers(2, m->pbo);
+  glDeleteTextures(1, &m->tex);
+  free(m->name);
   free(m);
 }
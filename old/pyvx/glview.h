@@ -1,12 +1,16 @@
 #ifndef __GLVIEW__H__
 #define __GLVIEW__H__
 
+#define GL_GLEXT_PROTOTYPES
 #include <GL/glut.h>
 
 struct glview {
   int win;
   char *name;
   unsigned int tex;
+  unsigned int pbo[2];
+  int pbo_index;
+  size_t size;
   int width, height;
   int pixel_type, pixel_size;
 };
@@ -6,7 +6,9 @@ import pyvx.inc.vx_kernels as kernels
 
 ffi = FFI()
 
-ffi.cdef('''
+# The declarations are kept around to allow other FFI instances, such as the
+# one compiled by pyvx.codegen.CApiBuilder, to declare the same types.
+cdefs = ['''
 #define VX_MAX_IMPLEMENTATION_NAME ...
 #define VX_MAX_KERNEL_NAME ...
 #define VX_MAX_LOG_MESSAGE_LEN ...
@@ -16,12 +18,12 @@ ffi.cdef('''
 */
 #define VX_VERSION_1_0 ...
 #define VX_VERSION ...
-''')
-
-ffi.cdef(vendors.cdef)
-ffi.cdef(types.cdef + kernels.cdef)
+''', vendors.cdef, types.cdef + kernels.cdef]
 # ffi.cdef(kernels.cdef)
 
+for cdef in cdefs:
+    ffi.cdef(cdef)
+
 class Enum(int):
     def __new__(cls, name, val):
         self = int.__new__(cls, val)
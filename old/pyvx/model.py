@@ -14,12 +14,11 @@ class attribute(object):
         self.default = default
 
     def __get__(self, instance, owner):
-        n = '_' + self.name
-        if hasattr(instance, n):
-            return getattr(instance, n)
-        if hasattr(owner, n):
-            return getattr(owner, n)
-        return self.default
+        # A single lookup, as this is hit for every parameter direction and
+        # type checked during verify
+        if instance is None:
+            instance = owner
+        return getattr(instance, '_' + self.name, self.default)
 
     def __set__(self, instance, value):
         setattr(instance, '_' + self.name, value)
@@ -479,7 +478,7 @@ class Graph(Reference):
     def verify(self):
         raise NotImplementedError
 
-    def process(self):
+    def process(self, block=False):
         raise NotImplementedError
 
 
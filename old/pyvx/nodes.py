@@ -95,10 +95,26 @@ as the input images and will use :func:`pyvx.types.result_color`  to
 replace  ``DF_IMAGE_VIRT`` colors among the output images. If this is not appropriate 
 it can be overridden.
 
+Elementwise nodes iterating over the same ``iteration_space`` are merged into a
+single loop by the ``OptimizedGraph`` and the intermediate images are kept in
+local variables instead of being written to memory. Nodes that can't be expressed
+as a ``body`` can still take part in this by overriding ``compile(code, noloop)``
+to only emit the loop if ``noloop`` is ``False``, as ``ChannelExtractNode`` does.
+Nodes setting ``fuses_consumers``, as ``Gaussian3x3Node`` and ``Sobel3x3Node``, in
+the same way take the elementwise nodes reading their outputs into their own loop.
+Their ``compile()`` then gets those nodes as a second argument, see
+``MergedStencilNode``.
+
 """
 from pyvx.backend import *
+from pyvx.codegen import _cached
 import cffi
+import numpy
 import os
+import re
+import time
+
+_block_cache = {}
 
 
 class ElementwiseNode(Node):
@@ -108,52 +124,112 @@ class ElementwiseNode(Node):
         inputs = self.input_images
         outputs = self.output_images + self.inout_images
         color = result_color(*[i.image_format for i in inputs])
+        first = inputs[0]
+        saturate = self.convert_policy == CONVERT_POLICY_SATURATE
         for img in outputs:
             img.suggest_color(color)
-            img.ensure_similar(inputs[0])
-            if self.convert_policy == CONVERT_POLICY_SATURATE:
+            img.ensure_similar(first)
+            if saturate:
                 if img.image_format.ctype not in self.small_ints:
                     raise InvalidFormatError(
                         "Saturated arithmetic only supported for 8- and 16- bit integers.")
 
+    @property
+    def iteration_space(self):
+        """ The ``(width, height, items)`` of the values iterated over. Nodes
+            can only be merged if they iterate over the same space.
+        """
+        img = (self.output_images + self.inout_images)[0]
+        return img.width, img.height, img.image_format.items
+
     def tmptype(self, ctype):
         if ctype in self.small_ints:
             return 'long'
         return ctype
 
     def compile(self, code, noloop=False):
-        iin = [p.name for p in self.parameters 
-                      if p.direction != OUTPUT and p.data_type == TYPE_IMAGE]
-        iout = [p.name for p in self.parameters 
-                      if p.direction != INPUT and p.data_type == TYPE_IMAGE]
-        magic = {'__tmp_image_%s' % name: getattr(self, name) for name in iin + iout}
-        setup = ''.join("%s %s;" % (self.tmptype(getattr(self, name).image_format.ctype), name)
-                        for name in iin + iout)
-        inp = ''.join("%s = __tmp_image_%s[__i];" % (name, name) for name in iin)
-        outp = ''.join("__tmp_image_%s[__i] = %s;" % (name, name) for name in iout)
-        if noloop:
-            head = ""
-        else:
-            head = "for (long __i = 0; __i < __tmp_image_%s.values; __i++) " % iin[0]
-        body = inp + self.body + outp
-        block = head + "{" + body + "}"
-        code.add_block(self, setup + block, **magic)
+        # The block only depends on the types and shapes of the images, so it
+        # is assembled once for each such combination
+        width, height, items = self.iteration_space
+        values = width * height * items
+        magic, images = {}, []
+        for p in self.parameters:
+            if p.data_type != TYPE_IMAGE:
+                continue
+            img = getattr(self, p.name)
+            fmt = img.image_format
+            magic['__tmp_image_' + p.name] = img
+            images.append((p.name, p.direction, fmt.ctype,
+                           img.width * img.height * fmt.items == values))
+        key = (type(self), self.body, noloop, values, tuple(images))
+        block = _cached(_block_cache, key, lambda: self.block(images, noloop, values))
+        if not noloop:
+            code.enable_openmp()
+        code.add_block(self, block, **magic)
+
+    def block(self, images, noloop, values):
+        # The temporaries are declared inside the loop body, which makes
+        # them private to each OpenMP thread
+        setup, inp, outp = [], [], []
+        if not noloop:
+            setup.append("#pragma omp parallel for simd schedule(static)\n"
+                         "for (long __i = 0; __i < %d; __i++) " % values)
+        setup.append("{")
+        for name, direction, ctype, direct in images:
+            setup.append("%s %s;" % (self.tmptype(ctype), name))
+            # Images spanning the entire loop are addressed without clamping
+            # the index, which lets gcc vectorize the loop, saturating clamps
+            # included. The magic names resolve to the image symbols declared
+            # by CoreImage.alloc(). Those are __restrict__ unless the image
+            # shares its buffer with another one, and assumed 64 byte aligned
+            # if pyvx allocated them, so gcc only adds alias checks or
+            # unaligned peeling for shared buffers and external data.
+            if direct:
+                access = '__tmp_image_%s.data[__i]' % name
+            else:
+                access = '__tmp_image_%s[__i]' % name
+            if direction != OUTPUT:
+                inp.append("%s = %s;" % (name, access))
+            if direction != INPUT:
+                outp.append("%s = %s;" % (access, name))
+        setup.extend(inp)
+        setup.append(self.body)
+        setup.extend(outp)
+        setup.append("}")
+        return ''.join(setup)
 
 
 class MergedElementwiseNode(MergedNode):
 
     def compile(self, code):
-        img = self.original_nodes[0].input_images[0]
+        width, height, items = self.original_nodes[0].iteration_space
+        # The optimized out images are scalars declared outside the loop
+        private = sorted(set(d.csym for n in self.original_nodes
+                             for d in n.input_images + n.output_images
+                             if d.optimized_out))
+        code.enable_openmp()
         code.add_code("\n// MergedElementwiseNode\n")
         code.indent_level += 4
-        code.add_code("for (long __i = 0; __i < %s; __i++) {\n" %
-                      img.getattr(self, "values"))
+        code.add_code("#pragma omp parallel for simd schedule(static)%s\n" %
+                      (" private(%s)" % ', '.join(private) if private else ""))
+        code.add_code("for (long __i = 0; __i < %d; __i++) {\n" %
+                      (width * height * items))
         for n in self.original_nodes:
             n.compile(code, True)
         code.indent_level -= 4
         code.add_code("}\n")
 
 
+class MergedStencilNode(MergedNode):
+    """ A node with ``fuses_consumers`` set, as ``Sobel3x3Node``, together
+        with the elementwise nodes consuming its outputs, which it compiles
+        into its own loop over the pixels.
+    """
+
+    def compile(self, code):
+        self.original_nodes[0].compile(code, self.original_nodes[1:])
+
+
 class BinaryOperationNode(ElementwiseNode):
     signature = (param('in1', INPUT, TYPE_IMAGE),
                  param('op',  INPUT, TYPE_STRING),
@@ -176,11 +252,32 @@ class MultiplyNode(ElementwiseNode):
                  param('out', OUTPUT, TYPE_IMAGE))
     kernel_enum =  KERNEL_MULTIPLY
 
+    def integer_divisor(self):
+        """ The integer ``d`` if ``scale`` is ``1/d`` for a power of two ``d``
+            and all images are integer, otherwise ``None``. Such a product is
+            exact and C division truncates toward zero as the conversion of
+            the floating point product did.
+        """
+        if not all(img.image_format.inttype for img in (self.in1, self.in2, self.out)):
+            return None
+        if not self.scale > 0:
+            return None
+        d = 1.0 / self.scale
+        if d == int(d) and int(d) & (int(d) - 1) == 0:
+            return int(d)
+
     @property
     def body(self):
+        d = self.integer_divisor()
         if self.round_policy == ROUND_POLICY_TO_ZERO:
+            if d == 1:
+                return "out = in1 * in2;"
+            if d is not None:
+                return "out = in1 * in2 / %d;" % d
             return "out = in1 * in2 * %r;" % self.scale
         elif self.round_policy == ROUND_POLICY_TO_NEAREST_EVEN:
+            if d == 1:
+                return "out = in1 * in2;"
             return "out = rint(in1 * in2 * %r);" % self.scale
         else:
             raise NotImplementedError
@@ -209,10 +306,26 @@ class TrueDivideNode(ElementwiseNode):
                  param('in2', INPUT, TYPE_IMAGE),
                  param('out', OUTPUT, TYPE_IMAGE))
 
-    body = "out = ((double) in1) / ((double) in2);"
+    # Inputs exactly representable as float are divided in single precision
+    float_ctypes = ElementwiseNode.small_ints + ('float',)
+
+    def single_precision(self):
+        for img in (self.in1, self.in2):
+            if isinstance(img, ConstantImage):
+                if numpy.float32(img.value) != img.value:
+                    return False
+            elif img.image_format.ctype not in self.float_ctypes:
+                return False
+        return True
+
+    @property
+    def body(self):
+        if self.out.color == DF_IMAGE_F32 and self.single_precision():
+            return "out = ((float) in1) / ((float) in2);"
+        return "out = ((double) in1) / ((double) in2);"
 
     def verify(self):
-        self.out.suggest_color(DF_IMAGE_F64)
+        self.out.suggest_color(DF_IMAGE_F32 if self.single_precision() else DF_IMAGE_F64)
         ElementwiseNode.verify(self)
 
 
@@ -222,7 +335,16 @@ class PowerNode(ElementwiseNode):
                  param('convert_policy', INPUT, TYPE_ENUM, CONVERT_POLICY_WRAP),
                  param('out', OUTPUT, TYPE_IMAGE))
 
-    body = "out = pow(in1, in2);"
+    @property
+    def body(self):
+        # Constant exponents that are small integers or 0.5 don't need pow()
+        if isinstance(self.in2, ConstantImage):
+            exponent = self.in2.value
+            if exponent in (1, 2, 3, 4):
+                return "out = %s;" % ' * '.join(['in1'] * int(exponent))
+            if exponent == 0.5:
+                return "out = sqrt(in1);"
+        return "out = pow(in1, in2);"
 
 
 class CompareNode(BinaryOperationNode):
@@ -255,25 +377,53 @@ class ColorConvertNode(Node):
         in_channels = self.input.image_format.channels
         out_channels = self.output.image_format.channels
         if CHANNEL_R in in_channels and CHANNEL_Y in out_channels:
+            # BT.709 in single precision, with the divisions folded into the
+            # coefficients of each output channel
+            kr, kb = 0.2126, 0.0722
+            kg = 1.0 - kr - kb
+            coeffs = (kr, kg, kb,
+                      -kr / (2.0 - 2.0*kb), -kg / (2.0 - 2.0*kb), 0.5,
+                      0.5, -kg / (2.0 - 2.0*kr), -kb / (2.0 - 2.0*kr))
+            # Both images are interleaved, so this is one stream in and one
+            # out whichever way the loop is split.
+            fin, fout = self.input.image_format, self.output.image_format
+            access = lambda name, fmt, channel, i: "%s.data[%s * %d + %d]" % (
+                name, i, fmt.items, fmt.offset(channel))
+            def pixel(i, chroma):
+                # Converts pixel i, writing its chroma at chroma if given
+                res = "{float r = %s, g = %s, b = %s;\n" % tuple(
+                    access('input', fin, c, i) for c in (CHANNEL_R, CHANNEL_G, CHANNEL_B))
+                res += "%s = yr*r + yg*g + yb*b;\n" % access('out', fout, CHANNEL_Y, i)
+                if chroma is not None:
+                    res += "%s = floorf(ur*r + ug*g + ub*b + offset);\n" % (
+                        access('out', fout, CHANNEL_U, chroma))
+                    res += "%s = floorf(vr*r + vg*g + vb*b + offset);\n" % (
+                        access('out', fout, CHANNEL_V, chroma))
+                return res + "}\n"
+            if fout.subsamp(CHANNEL_U) and fout.subsamp(CHANNEL_V):
+                # Pixel pairs share the chroma, which is taken from the second
+                # one, so the chroma of the first one is not computed
+                n = self.output.width * self.output.height
+                loop = "#pragma omp parallel for schedule(static)\n" \
+                       "for (long i = 0; i < %d; i += 2) {\n%s%s}\n" % (
+                    n - 1, pixel('i', None), pixel('(i + 1)', 'i'))
+                if n % 2:
+                    loop += pixel(str(n - 1), str(n - 1))
+            else:
+                loop = "#pragma omp parallel for schedule(static)\n" \
+                       "for (long i = 0; i < out.pixels; i++) {\n%s}\n" % pixel('i', 'i')
+            code.enable_openmp()
             code.add_block(self, """
-                double kr = 0.2126, kb = 0.0722, kg = 1.0 - kr - kb;
-                for (long i = 0; i < out.pixels; i++) {
-                    double r = ((double)input.channel_r[i]) / 256.0;
-                    double g = ((double)input.channel_g[i]) / 256.0;
-                    double b = ((double)input.channel_b[i]) / 256.0;
-                    double y = kr*r + kg*g + kb*b;
-                    double u = b/2.0 - (kr*r + kg*g) / (2.0 - 2.0*kb);
-                    double v = r/2.0 - (kb*b + kg*g) / (2.0 - 2.0*kr);
-                    out.channel_y[i] = y * 256.0;
-                    out.channel_u[i] = floor(u * 256.0 + 128.0);
-                    out.channel_v[i] = floor(u * 256.0 + 128.0);
-                }
-            """, out=self.output, input=self.input)
+                float yr = %.9g, yg = %.9g, yb = %.9g;
+                float ur = %.9g, ug = %.9g, ub = %.9g;
+                float vr = %.9g, vg = %.9g, vb = %.9g;
+                float offset = 128;
+            """ % coeffs + loop, out=self.output, input=self.input)
         else:
             raise NotImplementedError
 
 
-class ChannelExtractNode(Node):
+class ChannelExtractNode(ElementwiseNode):
     signature = (param('input', INPUT, TYPE_IMAGE),
                  param('channel', INPUT, TYPE_ENUM),
                  param('output', OUTPUT, TYPE_IMAGE))
@@ -287,12 +437,17 @@ class ChannelExtractNode(Node):
         self.output.ensure_color(DF_IMAGE_U8)
         self.output.ensure_shape(self.input)
 
-    def compile(self, code):
-        code.add_block(self, """
-            for (long i = 0; i < out.pixels; i++) {
-                out[i] = input.channel_%s[i];
-            }
-            """ % channel_char[self.channel],
+    def compile(self, code, noloop=False):
+        # Single channel output, so the loop over its values is over pixels
+        if noloop:
+            head = ""
+        else:
+            code.enable_openmp()
+            head = ("#pragma omp parallel for simd schedule(static)\n"
+                    "for (long __i = 0; __i < out.pixels; __i++) ")
+        fmt = self.input.image_format
+        code.add_block(self, head + "{out.data[__i] = input.data[%s(__i) * %d + %d];}"
+                       % (fmt.subsamp(self.channel), fmt.items, fmt.offset(self.channel)),
                        input=self.input, out=self.output)
 
 
@@ -315,35 +470,117 @@ class ChannelCombineNode(Node):
         self.plane2.ensure_shape(self.plane0)
 
     def compile(self, code):
+        # The planes are interleaved straight into the output, which gcc
+        # vectorizes into byte permutes (vpermt2b with AVX-512, vpshufb with
+        # AVX2) of its own, without alias checks where the pointers are
+        # restrict qualified (see ElementwiseNode.block()).
+        fmt = self.output.image_format
+        code.enable_openmp()
         code.add_block(self, """
+            #pragma omp parallel for simd schedule(static)
             for (long i = 0; i < out.pixels; i++) {
-                out.channel_r[i] = red[i];
-                out.channel_g[i] = green[i];
-                out.channel_b[i] = blue[i];
+                out.data[i * 3 + %d] = red.data[i];
+                out.data[i * 3 + %d] = green.data[i];
+                out.data[i * 3 + %d] = blue.data[i];
             }
-            """, red=self.plane0, green=self.plane1, blue=self.plane2, out=self.output)
-
+            """ % (fmt.offset(CHANNEL_R), fmt.offset(CHANNEL_G), fmt.offset(CHANNEL_B)),
+            red=self.plane0, green=self.plane1, blue=self.plane2, out=self.output)
+
+
+
+def _compile_consumers(node, consumers):
+    """ Compile the elementwise ``consumers`` fused into the loop of ``node``
+        by ``MergedStencilNode``, for its pixel ``(x, y)``. Returns the
+        declarations of the images optimized out by that, placed in the loop
+        body to keep them private to each iteration, and the code.
+    """
+    w = node.input.width
+    fused = Code()
+    nodes = [n for c in consumers for n in getattr(c, 'original_nodes', [c])]
+    for n in nodes:
+        n.compile(fused, True)
+    local = sorted(set((d.ctype, d.csym) for n in [node] + nodes
+                       for d in n.input_images + n.output_images
+                       if d.optimized_out))
+    local = ''.join("%s %s;" % d for d in local)
+    if not nodes:
+        return local, ""
+    # Without the // comments, which pycparser does not accept
+    return local, "{long __i = y * %d + x;\n%s}" % (w, re.sub(r'//[^\n]*', '', str(fused)))
 
 
 class Gaussian3x3Node(Node):
     signature = (param('input', INPUT, TYPE_IMAGE),
                  param('output', OUTPUT, TYPE_IMAGE))
     kernel_enum = KERNEL_GAUSSIAN_3x3
+    rows_per_band = 64
+    fuses_consumers = True
 
     def verify(self):
         self.ensure(self.input.image_format.items == 1)
         self.output.ensure_similar(self.input)
 
-    def compile(self, code):
+    def compile(self, code, consumers=()):
+        # The kernel is separated into a horizontal and a vertical 1-2-1 pass.
+        # Row y+1 of the horizontal pass is computed into a ring buffer of
+        # three rows, right before it is needed for output row y, so each
+        # input row is read from memory once and the buffer stays in a 48k
+        # L1 for rows of up to 4000 pixels (8000 for 8 bit input). Only its
+        # first and last columns and the rows outside the image depend on the
+        # border mode.
+        # The output is split into bands of rows processed in parallel, each
+        # with its own ring buffer, at the cost of two extra horizontal rows.
+        # Elementwise consumers are fused into the vertical pass as in
+        # Sobel3x3Node, so a chain of them reads the blurred pixels while
+        # they are still in registers instead of from memory.
+        w = self.input.width
+        # An 8 bit row sums to at most 4 * 255, which the vertical pass takes
+        # to 16 * 255, so 16 bit lanes suffice. gcc then processes 32 pixels
+        # per zero extend, add and shift, fast enough to be memory bound, so
+        # nothing would be gained from spelling it out with pmaddubsw.
+        if self.input.image_format.ctype == 'uint8_t':
+            tmp = 'uint16_t'
+        elif self.input.image_format.ctype in ElementwiseNode.small_ints:
+            tmp = 'int'
+        else:
+            tmp = 'long'
+        local, fused = _compile_consumers(self, consumers)
+        border = ''.join("""
+                    x = %d;
+                    row[((y + 5) %% 3) * %d + x] = img[x-1, y+1] + 2*img[x, y+1] + img[x+1, y+1];
+                    """ % (x, w) for x in sorted(set([0, w - 1])))
+        code.enable_openmp()
         code.add_block(self, """
-            for (long y = 0; y < img.height; y++) {
-                for (long x = 0; x < img.width; x++) {
-                    res[x, y] = (1*img[x-1, y-1] + 2*img[x, y-1] + 1*img[x+1, y-1] +
-                                 2*img[x-1, y]   + 4*img[x, y]   + 2*img[x+1, y]   +
-                                 1*img[x-1, y+1] + 2*img[x, y+1] + 1*img[x+1, y+1]) / 16;
+            #pragma omp parallel for schedule(static)
+            for (long y0 = 0; y0 < img.height; y0 += %d) {
+            long y1 = y0 + %d < img.height ? y0 + %d : img.height;
+            %s row[%d];
+            for (long y = y0 - 2; y < y1; y++) {
+                if (y + 1 >= 0 && y + 1 < img.height) {
+                    long x;
+                    %s
+                    for (x = 1; x < img.width - 1; x++) {
+                        long i = (y + 1) * img.width + x;
+                        row[((y + 5) %% 3) * %d + x] = img.data[i-1] + 2*img.data[i] + img.data[i+1];
+                    }
+                } else {
+                    for (long x = 0; x < img.width; x++) {
+                        row[((y + 5) %% 3) * %d + x] = img[x-1, y+1] + 2*img[x, y+1] + img[x+1, y+1];
+                    }
+                }
+                if (y >= y0) {
+                    for (long x = 0; x < img.width; x++) {
+                        %s
+                        res.data[y * %d + x] = (1*row[((y + 3) %% 3) * %d + x] +
+                                                2*row[((y + 4) %% 3) * %d + x] +
+                                                1*row[((y + 5) %% 3) * %d + x]) / 16;
+                        %s
+                    }
                 }
             }
-            """, img=self.input, res=self.output)
+            }
+            """ % ((self.rows_per_band,) * 3 + (tmp, 3 * w, border, w, w, local, w, w, w, w, fused)),
+            img=self.input, res=self.output)
 
 
 class Sobel3x3Node(Node):
@@ -351,6 +588,8 @@ class Sobel3x3Node(Node):
                  param('output_x', OUTPUT, TYPE_IMAGE),
                  param('output_y', OUTPUT, TYPE_IMAGE))
     kernel_enum = KERNEL_SOBEL_3x3
+    rows_per_band = 64
+    fuses_consumers = True
 
     def verify(self):
         self.ensure(self.input.image_format.items == 1)
@@ -363,18 +602,82 @@ class Sobel3x3Node(Node):
         self.output_x.ensure_similar(self.input)
         self.output_y.ensure_similar(self.input)
 
-    def compile(self, code):
+    def compile(self, code, consumers=()):
+        # Separable, as Gaussian3x3Node, with the horizontal difference and
+        # 1-2-1 sum of each row kept in ring buffers of three rows. Both are
+        # computed from the same three loads, shared by dx and dy, instead of
+        # the twelve loads of two 3x3 stencils. Bands of rows are processed in
+        # parallel, also as in Gaussian3x3Node.
+        #
+        # The elementwise consumers, fused by MergedStencilNode, are compiled
+        # into the inner loop right after each pair of gradients is stored.
+        # Images optimized out by that are declared in the loop body, which
+        # keeps them private to each iteration.
+        w = self.input.width
+        tmp = 'int' if self.input.image_format.ctype in ElementwiseNode.small_ints else 'long'
+        local, fused = _compile_consumers(self, consumers)
+        nodes = [n for c in consumers for n in getattr(c, 'original_nodes', [c])]
+        # A gradient optimized out and not read by a fused consumer is dead,
+        # and so is the ring buffer it is computed from
+        live = [not d.optimized_out or any(d in n.inputs for n in nodes)
+                for d in (self.output_x, self.output_y)]
+        if not any(live):
+            return
+        buffers, horizontal, vertical = [], [], []
+        if live[0]:
+            buffers.append("diff[%d]" % (3 * w))
+            horizontal.append("diff[i] = img[x+1, y+1] - img[x-1, y+1];")
+            vertical.append("dx.data[y * %d + x] = diff[top] + 2*diff[mid] + diff[bot];" % w)
+        if live[1]:
+            buffers.append("sum[%d]" % (3 * w))
+            horizontal.append("sum[i] = img[x-1, y+1] + 2*img[x, y+1] + img[x+1, y+1];")
+            vertical.append("dy.data[y * %d + x] = sum[bot] - sum[top];" % w)
+        horizontal = '\n'.join(horizontal)
+        direct = re.sub(r'img\[x([+-]1)?, y\+1\]',
+                        lambda m: 'img.data[j%s]' % (m.group(1) or ''), horizontal)
+        border = ''.join("""
+                    x = %d;
+                    i = ((y + 5) %% 3) * %d + x;
+                    %s
+                    """ % (x, w, horizontal) for x in sorted(set([0, w - 1])))
+        code.enable_openmp()
         code.add_block(self, """
-            for (long y = 0; y < img.height; y++) {
-                for (long x = 0; x < img.width; x++) {
-                    dx[x, y] = (-1*img[x-1, y-1] + 1*img[x+1, y-1] +
-                                -2*img[x-1, y]   + 2*img[x+1, y]   +
-                                -1*img[x-1, y+1] + 1*img[x+1, y+1]);
-                    dy[x, y] = (-1*img[x-1, y-1] - 2*img[x, y-1] - 1*img[x+1, y-1] +
-                                 1*img[x-1, y+1] + 2*img[x, y+1] + 1*img[x+1, y+1]);
+            #pragma omp parallel for schedule(static)
+            for (long y0 = 0; y0 < img.height; y0 += %d) {
+            long y1 = y0 + %d < img.height ? y0 + %d : img.height;
+            %s %s;
+            for (long y = y0 - 2; y < y1; y++) {
+                if (y + 1 >= 0 && y + 1 < img.height) {
+                    long x;
+                    long i;
+                    %s
+                    for (x = 1; x < img.width - 1; x++) {
+                        long j = (y + 1) * img.width + x;
+                        i = ((y + 5) %% 3) * %d + x;
+                        %s
+                    }
+                } else {
+                    for (long x = 0; x < img.width; x++) {
+                        long i = ((y + 5) %% 3) * %d + x;
+                        %s
+                    }
+                }
+                if (y >= y0) {
+                    for (long x = 0; x < img.width; x++) {
+                        long top = ((y + 3) %% 3) * %d + x;
+                        long mid = ((y + 4) %% 3) * %d + x;
+                        long bot = ((y + 5) %% 3) * %d + x;
+                        %s
+                        %s
+                        %s
+                    }
                 }
             }
-            """, img=self.input, dx=self.output_x, dy=self.output_y)
+            }
+            """ % ((self.rows_per_band,) * 3 + (tmp, ', '.join(buffers), border, w, direct,
+                                                w, horizontal, w, w, w, local,
+                                                '\n'.join(vertical), fused)),
+            img=self.input, dx=self.output_x, dy=self.output_y)
 
 
 class MagnitudeNode(ElementwiseNode):
@@ -396,6 +699,9 @@ class MagnitudeNode(ElementwiseNode):
         self.mag.ensure_similar(self.grad_x)
         self.mag.ensure_similar(self.grad_y)
 
+    # Vectorized by gcc (vsqrtpd), and as fast as copying the images, so
+    # neither sqrtf nor rsqrt would gain anything, but would lose precision
+    # for large 16 bit gradients
     body = "mag = sqrt( grad_x * grad_x + grad_y * grad_y );"
 
 
@@ -412,7 +718,25 @@ class PhaseNode(ElementwiseNode):
         self.orientation.ensure_similar(self.grad_x)
         self.orientation.ensure_similar(self.grad_y)
 
-    body = "orientation = (atan2(grad_y, grad_x) + M_PI) * (255.0 / 2.0 / M_PI);"
+    # atan2() is a libm call per pixel, which keeps the loop scalar. Instead
+    # the angle of the first octant is evaluated with the polynomial of
+    # Abramowitz and Stegun 4.4.49, accurate to 2e-8 radians, and mirrored into
+    # place with selects, which gcc vectorizes.
+    body = """
+        double ax = fabs(grad_x);
+        double ay = fabs(grad_y);
+        double mn = ax < ay ? ax : ay;
+        double mx = ax < ay ? ay : ax;
+        double z = mx > 0 ? mn / mx : 0;
+        double s = z * z;
+        double a = z * (0.9999993329 + s * (-0.3332985605 + s * (0.1994653599 +
+                   s * (-0.1390853351 + s * (0.0964200441 + s * (-0.0559098861 +
+                   s * (0.0218612288 + s * -0.0040540580)))))));
+        a = ay > ax ? M_PI / 2 - a : a;
+        a = grad_x < 0 ? M_PI - a : a;
+        a = grad_y < 0 ? -a : a;
+        orientation = (a + M_PI) * (255.0 / 2.0 / M_PI);
+    """
 
 
 class AccumulateImageNode(Node):
@@ -430,21 +754,28 @@ class PlayNode(Node):
     signature = (param('path', INPUT, TYPE_STRING),
                  param('output', OUTPUT, TYPE_IMAGE))
     player = None
+    deadline = None
+    # Number of frames decoded ahead in the background for non-live sources
+    prefetch_frames = 3
 
     ffi = cffi.FFI()
     ffi.cdef("""
             struct avplay {
                 int width, height;
+                double frame_duration;
+                int live;
                 ...;
             };
             struct avplay *avplay_new(char *fn);
             int avplay_next(struct avplay *p, uint8_t *img);
+            int avplay_start_prefetch(struct avplay *p, int slots);
+            void avplay_stop_prefetch(struct avplay *p);
             """)
     try:
         lib = ffi.verify(open(os.path.join(mydir, 'avplay.c')).read(),
-                         extra_compile_args=['-O3'],
+                         extra_compile_args=['-O3', '-pthread'],
                          libraries=['avformat', 'avcodec', 'avutil',
-                                    'swscale', 'avdevice'],
+                                    'swscale', 'avdevice', 'pthread'],
                          )
     except (cffi.VerificationError, IOError) as e:
         print e
@@ -467,6 +798,8 @@ class PlayNode(Node):
                 ''')
         if not self.player:
             self.player = self.lib.avplay_new(str(self.path))
+            if self.player and not self.player.live and self.prefetch_frames:
+                self.lib.avplay_start_prefetch(self.player, self.prefetch_frames)
         if not self.player:
             raise InvalidValueError(
                 "Unable to decode '%s'." % self.path)
@@ -475,15 +808,27 @@ class PlayNode(Node):
         self.output.force()
 
     def compile(self, code):
-        adr = int(self.ffi.cast('long', self.player))
         code.add_block(
-            self, "if (avplay_next((void *)0x%x, img.data)) return VX_ERROR_GRAPH_ABANDONED;" % adr, img=self.output)
+            self, "if (avplay_next(%s, img.data)) return VX_ERROR_GRAPH_ABANDONED;" % code.add_pointer(self.player), img=self.output)
         code.extra_link_args.append(self.ffi.verifier.modulefilename)
         code.includes.add('#include "avplay.h"')
 
-    # FIXME
-    #def __del__(self):
-    #    self.lib.avplay_release(self.player) 
+    def wait(self):
+        # Live sources block in avplay_next() until the next frame is captured
+        if self.player.live or self.player.frame_duration <= 0:
+            return
+        now = time.time()
+        if self.deadline is None or self.deadline < now - self.player.frame_duration:
+            self.deadline = now
+        elif self.deadline > now:
+            time.sleep(self.deadline - now)
+        self.deadline += self.player.frame_duration
+
+    def __del__(self):
+        # The decoding thread writes into the player and the ring
+        if self.player:
+            self.lib.avplay_stop_prefetch(self.player)
+        # FIXME: release the player itself
 
 
 class ShowNode(Node):
@@ -540,9 +885,8 @@ class ShowNode(Node):
                                              str(self.name))
 
     def compile(self, code):
-        adr = int(self.ffi.cast('long', self.viewer))
         code.add_block(
-            self, "if (glview_next((void *)0x%x, img.data)) return VX_ERROR_GRAPH_ABANDONED;" % adr, img=self.input)
+            self, "if (glview_next(%s, img.data)) return VX_ERROR_GRAPH_ABANDONED;" % code.add_pointer(self.viewer), img=self.input)
         code.extra_link_args.append(self.ffi.verifier.modulefilename)
         code.includes.add('#include "glview.h"')
 
@@ -577,4 +921,14 @@ class HarrisCornersNode(Node):
         pass # FIXME
 
     def compile(self, code):
-        pass # FIXME
+        # FIXME: Planned layout, to keep the block_size window O(1) per pixel:
+        #  1. Gx*Gx, Gx*Gy and Gy*Gy from the Sobel gradients as one merged
+        #     elementwise pass into int32 images.
+        #  2. Box sums of these over block_size x block_size from running sums,
+        #     horizontal per row into a ring buffer of block_size rows and
+        #     vertical over that, as in Sobel3x3Node. That is four additions
+        #     per pixel, without the int32 overflow of an integral image of
+        #     the whole frame.
+        #  3. The response det - k * trace**2, thresholding and non-maximum
+        #     suppression over min_distance, appending to the corners array.
+        pass
@@ -8,6 +8,7 @@ class OptimizedGraph(CoreGraph):
         self.identify_consumers()
         self.identify_relations()
         self.merge_elementwise_nodes()
+        self.fuse_stencil_consumers()
         self.ded_code_removal()
 
     def identify_consumers(self):
@@ -57,29 +58,32 @@ class OptimizedGraph(CoreGraph):
                 assert False
 
     def merge_elementwise_nodes(self):
+        # Nodes iterating over different spaces can't share a loop, so one
+        # group is formed for each such space
         scheduler = Scheduler(self.nodes, self.images)
-        active_group = []
+        active_groups = defaultdict(list)
         delayed_nodes = []
         while scheduler.blocked_nodes:
             while scheduler.loaded_nodes:
-                node = scheduler.loaded_nodes.pop()
+                node = scheduler.loaded_nodes.popleft()
                 if isinstance(node, ElementwiseNode):
-                    active_group.append(node)
+                    active_groups[node.iteration_space].append(node)
                     scheduler.fire(node)
                 else:
                     for n in node.parents:
-                        if n in active_group:
+                        if any(n in g for g in active_groups.values()):
                             delayed_nodes.append(node)
                             break
                     else:
                         scheduler.fire(node)
-            if len(active_group) == 1:
-                scheduler.fire(active_group[0])
-            elif len(active_group) > 1:
-                for n in active_group:
-                    self.nodes.remove(n)
-                scheduler.fire(MergedElementwiseNode(self, active_group))
-            active_group = []
+            for active_group in active_groups.values():
+                if len(active_group) == 1:
+                    scheduler.fire(active_group[0])
+                elif len(active_group) > 1:
+                    for n in active_group:
+                        self.nodes.remove(n)
+                    scheduler.fire(MergedElementwiseNode(self, active_group))
+            active_groups = defaultdict(list)
             for n in delayed_nodes:
                 scheduler.fire(n)
             delayed_nodes = []
@@ -89,4 +93,37 @@ class OptimizedGraph(CoreGraph):
         self.identify_consumers()
         self.identify_relations()
 
+    def fuse_stencil_consumers(self):
+        # Elementwise nodes (or merged groups of them) iterating over the
+        # pixels of a node with fuses_consumers, and reading its outputs, are
+        # compiled into its loop. They must not need anything produced after
+        # it in the schedule. Its outputs read only by them are then
+        # optimized out by ded_code_removal.
+        for stencil in [n for n in self.nodes if getattr(n, 'fuses_consumers', False)]:
+            img = stencil.input_images[0]
+            space = (img.width, img.height, 1)
+            available = set(self.nodes[:self.nodes.index(stencil)])
+            outputs = set(stencil.outputs)
+            group = []
+            for n in self.nodes[self.nodes.index(stencil) + 1:]:
+                if not isinstance(n, (ElementwiseNode, MergedElementwiseNode)):
+                    continue
+                if getattr(n, 'original_nodes', [n])[0].iteration_space != space:
+                    continue
+                if not outputs.intersection(n.inputs):
+                    continue
+                if all(d in outputs or getattr(d, 'producer', None) is None or
+                       d.producer in available for d in n.inputs):
+                    group.append(n)
+                    outputs.update(n.outputs)
+            if group:
+                for n in [stencil] + group:
+                    self.nodes.remove(n)
+                MergedStencilNode(self, [stencil] + group)
+
+        # Restore invariants
+        self.nodes = self.schedule()
+        self.identify_consumers()
+        self.identify_relations()
+
 
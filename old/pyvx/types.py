@@ -2,6 +2,8 @@ from cffi import FFI
 import numpy, traceback
 from pyvx.inc.vx import *
 
+_ffi = FFI()
+
 class ExtraChannel(object):
     def __init__(self, name):
         self.name = name
@@ -32,6 +34,9 @@ channel_char = {
     CHANNEL_V: 'v',
 }
 
+# By the name of the magic accessor, e.g. img.channel_r
+channel_by_name = dict(('channel_' + c, ch) for ch, c in channel_char.items())
+
 class ImageFormatMeta(type):
     def __new__(cls, name, bases, attrs):
         cls = type.__new__(cls, name, bases, attrs)
@@ -40,7 +45,7 @@ class ImageFormatMeta(type):
             cls.dtype = numpy.dtype(cls.dtype)
             if not cls.ctype:
                 cls.ctype = cls.dtype.name + '_t'
-            assert FFI().sizeof(cls.ctype) == cls.dtype.itemsize
+            assert _ffi.sizeof(cls.ctype) == cls.dtype.itemsize
             if cls.items == 1:
                 assert cls.dtype not in ImageFormat.dtype2color
                 ImageFormat.dtype2color[cls.dtype] = cls.color
@@ -1,14 +1,27 @@
 import sys, os
 sys.path = [os.path.dirname(os.path.dirname(__file__))] + sys.path
+from tempfile import mkdtemp
+from shutil import rmtree
 
 def pytest_addoption(parser):
     group = parser.getgroup("pyvx")
     group._addoption('--src',
                      action="store_true", dest="show_src", default=False,
                      help="print the produced C-code")
+    group._addoption('--numba',
+                     action="store_true", dest="use_numba", default=False,
+                     help="build the graphs with numba instead of a C compiler")
 
 def pytest_configure(config):
+    # Keep the compiled graphs out of the home directory
+    import pyvx.backend
+    pyvx.backend.CoreGraph.cache_dir = mkdtemp()
     if config.getvalue("show_src"):
-        import pyvx.backend
         config.option.capture = 'no'
         pyvx.backend.CoreGraph.show_source = True
+    if config.getvalue("use_numba"):
+        pyvx.backend.CoreGraph.use_numba = True
+
+def pytest_unconfigure(config):
+    import pyvx.backend
+    rmtree(pyvx.backend.CoreGraph.cache_dir, ignore_errors=True)
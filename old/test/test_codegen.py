@@ -0,0 +1,256 @@
+from pyvx import *
+from pyvx.codegen import cparse, Code, MagicRewriter, NoFastPath, CApiBuilder
+from cffi import FFI, VerificationError
+from array import array
+import pytest
+from pycparser.c_generator import CGenerator
+
+
+class FakeVar(object):
+    def getattr(self, node, attr):
+        return attr.upper()
+
+    def getitem(self, node, channel, idx):
+        return 'get(%s, %r)' % (channel, idx)
+
+    def setitem(self, node, channel, idx, op, value):
+        return 'set(%s, %r, %s, %s)' % (channel, idx, op, value)
+
+
+class Handled(object):
+    def __init__(self, value):
+        self.value = value
+
+    def new_handle(self):
+        self.handle = FFI().new_handle(self)
+        return self.handle
+
+
+class TestCodegen(object):
+
+    def test_cparse_cached(self):
+        code = "for (long i = 0; i < 10; i++) {a[i] = b[i];}"
+        assert cparse(code) is cparse(code)
+        assert cparse(code) is not cparse(code + ";")
+
+    def test_add_block_reuses_template(self):
+        g = Graph()
+        with g:
+            img = Image(3, 4, DF_IMAGE_U8, array('B', range(12)))
+            g1 = Gaussian3x3(img)
+            g2 = Gaussian3x3(img)
+            g1.force()
+            g2.force()
+        g.process()
+        assert [g1.data[i] for i in range(12)] == [g2.data[i] for i in range(12)]
+        assert g1.data[4] == 4
+
+    def test_elementwise_block_cached(self):
+        from pyvx import nodes
+        g = Graph()
+        with g:
+            img = Image(3, 4, DF_IMAGE_U8, array('B', range(12)))
+            a = img + img
+            b = img + img
+            a.force()
+            b.force()
+        g.verify()
+        nodes._block_cache.clear()
+        code = Code()
+        for n in (a.producer, b.producer):
+            n.compile(code)
+        assert len(nodes._block_cache) == 1
+        assert a.csym in str(code) and b.csym in str(code)
+
+    def test_gaussian_separable(self):
+        w, h = 7, 5
+        data = array('B', [(i * 37) % 256 for i in range(w * h)])
+        g = Graph()
+        with g:
+            img = Image(w, h, DF_IMAGE_U8, data)
+            res = Gaussian3x3(img)
+            res.producer.border_mode = BORDER_MODE_REPLICATE
+            res.force()
+        g.process()
+        px = lambda x, y: data[min(max(y, 0), h - 1) * w + min(max(x, 0), w - 1)]
+        for y in range(h):
+            for x in range(w):
+                s = sum(px(x + i, y + j) * (2 - abs(i)) * (2 - abs(j))
+                        for i in (-1, 0, 1) for j in (-1, 0, 1))
+                assert res.data[y * w + x] == s // 16
+
+    def test_sobel_separable(self):
+        w, h = 7, 5
+        data = array('B', [(i * 37) % 256 for i in range(w * h)])
+        g = Graph()
+        with g:
+            img = Image(w, h, DF_IMAGE_U8, data)
+            dx, dy = Sobel3x3(img)
+            dx.producer.border_mode = BORDER_MODE_REPLICATE
+            dx.force()
+            dy.force()
+        g.process()
+        px = lambda x, y: data[min(max(y, 0), h - 1) * w + min(max(x, 0), w - 1)]
+        for y in range(h):
+            for x in range(w):
+                gx = sum((px(x + 1, y + j) - px(x - 1, y + j)) * (2 - abs(j)) for j in (-1, 0, 1))
+                gy = sum((px(x + i, y + 1) - px(x + i, y - 1)) * (2 - abs(i)) for i in (-1, 0, 1))
+                assert (dx.data[y * w + x], dy.data[y * w + x]) == (gx, gy)
+
+    def test_openmp(self):
+        g = Graph()
+        with g:
+            img = Image(3, 4, DF_IMAGE_U8, array('B', range(12)))
+            gauss = Gaussian3x3(img)
+            sa = img + img
+            gauss.force()
+            sa.force()
+        g.verify()
+        code = Code()
+        for n in g.nodes:
+            n.compile(code)
+        assert str(code).count('#pragma omp parallel for') == 2
+        assert code.extra_compile_args == code.extra_link_args == ['-fopenmp']
+
+    def test_parser_path_shares_ast(self):
+        code = "img[i] = img.width;"
+        ast = cparse(code)
+        Code.fast_rewrite = False
+        try:
+            for i in range(2):
+                c = Code()
+                c.add_block(None, code, img=FakeVar())
+                assert "set(None, 'i', =, WIDTH)" in str(c)
+        finally:
+            Code.fast_rewrite = True
+        assert cparse(code) is ast
+        assert 'img.width' in CGenerator().visit(ast)
+
+    def test_magic_rewriter(self):
+        r = MagicRewriter(None, {'img': FakeVar(), 'res': FakeVar()})
+        assert r.rewrite("res[x, y] = img[x-1, y] + img.width;") == \
+            "set(None, ('x', 'y'), =, get(None, ('x-1', 'y')) + WIDTH);"
+        assert r.rewrite("res.channel_r[i] += f(img[i], 2), x = (img[i] == 3);") == \
+            "set(channel_r, 'i', +=, f(get(None, 'i'), 2)), x = (get(None, 'i') == 3);"
+        assert r.rewrite("myimg[i] = s.img[i] + img;") == "myimg[i] = s.img[i] + img;"
+        with pytest.raises(NoFastPath):
+            r.rewrite("img[(i] = 0;")
+        with pytest.raises(NoFastPath):
+            r.rewrite("img[1, 2, 3] = 0;")
+
+    def test_fast_rewrite_matches_parser(self):
+        results = []
+        for fast in (True, False):
+            Code.fast_rewrite = fast
+            try:
+                g = Graph()
+                with g:
+                    img = Image(3, 4, DF_IMAGE_RGB, array('B', range(36)))
+                    dx, dy = Sobel3x3(Gaussian3x3(img.channel_g))
+                    mag = Magnitude(dx, dy)
+                    sa = img.channel_r + img.channel_b
+                    mag.force()
+                    sa.force()
+                g.process()
+            finally:
+                Code.fast_rewrite = True
+            results.append([mag.data[i] for i in range(12)] +
+                           [sa.data[i] for i in range(12)])
+        assert results[0] == results[1]
+
+    def test_capi_builder_externs(self):
+        ffi = FFI()
+        ffi.cdef("typedef int vx_status;")
+        builder = CApiBuilder(ffi)
+        builder.add_function("vx_status vxFoo(int a, char *b)", lambda a, b: 0)
+        builder.add_function("void vxBar(int n)", lambda n: None)
+        assert builder.cdef == ['extern "Python+C" int vxFoo(int, char *);',
+                                'extern "Python+C" void vxBar(int);']
+        assert builder.typeof("void vxBar(int n)") is builder.typeof("void vxBar(int n)")
+
+    def test_capi_builder_callback(self):
+        ffi = FFI()
+        ffi.cdef("typedef struct _obj *obj;")
+        builder = CApiBuilder(ffi)
+        builder.add_wrapped_reference_type('obj')
+        builder.exception_handler = lambda e, tp: -1
+        builder.add_function("obj clone(int n, obj o)", lambda n, o: Handled([n, o]))
+        builder.add_function("int fail(int n)", lambda n: 1 / n)
+        src = ffi.new_handle('hello')
+        res = builder.callbacks['clone'](3, ffi.cast('obj', src))
+        assert ffi.from_handle(res).value == [3, 'hello']
+        assert builder.callbacks['fail'](1) == 1
+        assert builder.callbacks['fail'](0) == -1
+
+    def test_numba_source_matches_c(self):
+        g = Graph()
+        with g:
+            img = Image(6, 4, DF_IMAGE_RGB, array('B', range(0, 216, 3)))
+            gray = ColorConvert(img)
+            gray.color = DF_IMAGE_UYVY
+            dx, dy = Sobel3x3(Gaussian3x3(img.channel_g))
+            mag = Magnitude(dx, dy)
+            phase = Phase(dx, dy)
+            sa = (img.channel_r + img.channel_b) / 3 - dx
+            for res in (gray, mag, phase, sa):
+                res.force()
+        g.process()
+        arrays = g.image_arrays()
+        outputs = [d.as_array() for d in (gray, mag, phase, sa)]
+        expected = [list(a) for a in outputs]
+        for a in outputs:
+            a[:] = 0
+        code = Code(''.join(d.cdeclaration for d in g.images))
+        for n in g.nodes:
+            n.compile(code)
+        assert 'prange(' in code.numba_source(arrays)
+        code.build_numba(arrays, jit=False)()
+        assert [list(a) for a in outputs] == expected
+
+    def test_numba_unsupported(self):
+        code = Code("int *ptr = 0; ptr[1] = 7;")
+        with pytest.raises(NoFastPath):
+            code.numba_source({})
+        code = Code("int buf[2]; for (long i = 0; i < 3; i++) { buf[i % 2] = i; }")
+        assert 'prange(' not in code.numba_source({})
+        code = Code("for (long i = 0; i < 3; i++) { if (i == 1) continue; }")
+        with pytest.raises(NoFastPath):
+            code.numba_source({})
+
+    def test_numba_graph(self):
+        pytest.importorskip('numba')
+        g = Graph()
+        g.use_numba = True
+        with g:
+            img = Image(3, 4, DF_IMAGE_U8, array('B', range(12)))
+            res = Gaussian3x3(img)
+            res.force()
+        g.process()
+        assert res.data[4] == 4
+
+    def test_numba_fallback(self, monkeypatch):
+        from pyvx import codegen
+        monkeypatch.setenv('CC', 'pyvx-no-such-cc')
+        monkeypatch.setenv('PYVX_NO_CACHE', '1')
+        g = Graph()
+        with g:
+            img = Image(3, 4, DF_IMAGE_U8, array('B', range(12)))
+            res = Gaussian3x3(img)
+            res.force()
+        if codegen.numba is None:
+            with pytest.raises(VerificationError):
+                g.process()
+        else:
+            g.process()
+            assert res.data[4] == 4
+
+    @pytest.mark.skipif("Graph.use_numba")
+    def test_compiler_error_not_hidden(self, monkeypatch):
+        monkeypatch.setenv('CC', 'false')
+        monkeypatch.setenv('PYVX_NO_CACHE', '1')
+        g = Graph()
+        with g:
+            img = Image(3, 4, DF_IMAGE_U8, array('B', range(12)))
+            Gaussian3x3(img).force()
+        with pytest.raises(VerificationError):
+            g.process()
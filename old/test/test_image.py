@@ -1,5 +1,7 @@
 import py.test
 from pyvx import *
+from cffi import FFI
+import numpy
 
 class TestImage(object):
     def test_imagepatch_addressing(self):
@@ -13,3 +15,43 @@ class TestImage(object):
         assert(img.imagepatch_addressing[0].scale_y == SCALE_UNITY)
         assert(img.imagepatch_addressing[0].stride_x == 1)
         assert(img.imagepatch_addressing[0].stride_y == 640)
+
+    def test_alloc_aligned(self):
+        with Graph() as g:
+            img = Image(7, 3, DF_IMAGE_U8)
+            res = Gaussian3x3(img)
+            res.force()
+        g.process()
+        for i in (img, res):
+            assert int(FFI().cast('long', i.data)) % 64 == 0
+            assert '__builtin_assume_aligned' in i.cdeclaration
+        assert res._buffer is img._buffer
+
+    def test_numpy_data(self):
+        a = numpy.arange(12, dtype=numpy.uint8).reshape(4, 3)
+        with Graph() as g:
+            img = Image(3, 4, DF_IMAGE_U8, a)
+            res = img + img
+            res.force()
+        g.process()
+        assert list(res.as_array()) == range(0, 24, 2)
+        a[1, 1] = 100
+        g.process()
+        assert res.data[4] == 200
+        with Graph():
+            with py.test.raises(AssertionError):
+                Image(3, 4, DF_IMAGE_U8, a.T)
+            with py.test.raises(AssertionError):
+                Image(3, 4, DF_IMAGE_S16, a)
+
+    def test_external_alignment(self):
+        buf = numpy.zeros(12 + 64, numpy.uint8)
+        off = -buf.__array_interface__['data'][0] % 64
+        for a in (buf[off:off + 12], buf[off + 1:off + 13]):
+            with Graph() as g:
+                img = Image(3, 4, DF_IMAGE_U8, a)
+                res = img + img
+                res.force()
+            g.process()
+            assert img.cdeclaration.endswith(', 1);\n')
+            assert res.cdeclaration.endswith(', 64);\n')
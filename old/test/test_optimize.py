@@ -1,5 +1,7 @@
 from pyvx import *
+from pyvx.codegen import Code
 from array import array
+from math import sqrt
 
 
 class TestOptimize(object):
@@ -25,6 +27,24 @@ class TestOptimize(object):
         assert gdx.data[55] == 8
         assert gdx.data[66] == 8
 
+    def test_dead_sobel_gradient(self):
+        g = Graph()
+        with g:
+            img = Image(10, 10, DF_IMAGE_U8, array('B', range(100)))
+            dx, dy = Sobel3x3(img)
+            dx.force()
+        g.verify()
+        assert dy.optimized_out
+        code = Code()
+        dx.producer.compile(code)
+        assert 'diff[' in str(code) and 'sum[' not in str(code)
+        g.process()
+        assert dx.data[55] == 8
+        dx.optimized_out = True
+        code = Code()
+        dx.producer.compile(code)
+        assert str(code).strip() == ''
+
     def test_merge_elementwise(self):
         g = Graph()
         with g:
@@ -65,3 +85,100 @@ class TestOptimize(object):
         assert res.data[9 * 20 + 9] == 98
         assert res.data[10 * 20 + 10] == 30
         assert res.data[11 * 20 + 11] == 36
+
+    def test_merge_channel_extract(self):
+        g = Graph()
+        with g:
+            img = Image(4, 5, DF_IMAGE_RGB, array('B', range(60)))
+            small = Image(2, 2, DF_IMAGE_U8, array('B', range(4)))
+            r, b = img.channel_r, img.channel_b
+            sa = r + b
+            sb = small + small
+            sa.force()
+            sb.force()
+        g.verify()
+        assert r.producer is sa.producer
+        assert sb.producer is not sa.producer
+        assert r.optimized_out
+        g.process()
+        assert [sa.data[i] for i in range(3)] == [2, 8, 14]
+        assert [sb.data[i] for i in range(4)] == [0, 2, 4, 6]
+
+    def test_merge_openmp(self):
+        g = Graph()
+        with g:
+            img = Image(4, 5, DF_IMAGE_U8, array('B', range(20)))
+            t = img + 1
+            res = t * 2
+            res.force()
+        g.verify()
+        code = Code()
+        for n in g.nodes:
+            n.compile(code)
+        assert "#pragma omp parallel for simd schedule(static) private(%s)\n" % t.csym in str(code)
+        assert '-fopenmp' in code.extra_compile_args
+        g.process()
+        assert [res.data[i] for i in range(3)] == [2, 4, 6]
+
+    def test_fuse_sobel_consumers(self):
+        w, h = 7, 5
+        data = array('B', [(i * 37) % 256 for i in range(w * h)])
+        g = Graph()
+        with g:
+            img = Image(w, h, DF_IMAGE_U8, data)
+            dx, dy = Sobel3x3(img)
+            dx.producer.border_mode = BORDER_MODE_REPLICATE
+            mag = Magnitude(dx, dy)
+            mag.force()
+        g.verify()
+        assert len(g.nodes) == 1
+        assert dx.optimized_out and dy.optimized_out
+        g.process()
+        px = lambda x, y: data[min(max(y, 0), h - 1) * w + min(max(x, 0), w - 1)]
+        for y in range(h):
+            for x in range(w):
+                gx = sum((px(x + 1, y + j) - px(x - 1, y + j)) * (2 - abs(j)) for j in (-1, 0, 1))
+                gy = sum((px(x + i, y + 1) - px(x + i, y - 1)) * (2 - abs(i)) for i in (-1, 0, 1))
+                assert mag.data[y * w + x] == int(sqrt(gx * gx + gy * gy))
+
+    def test_fuse_gaussian_consumers(self):
+        w, h = 7, 5
+        data = array('B', [(i * 37) % 256 for i in range(w * h)])
+        g = Graph()
+        with g:
+            img = Image(w, h, DF_IMAGE_U8, data)
+            gauss = Gaussian3x3(img)
+            gauss.producer.border_mode = BORDER_MODE_REPLICATE
+            res = gauss + img
+            res.force()
+        g.verify()
+        assert len(g.nodes) == 1
+        assert gauss.optimized_out
+        g.process()
+        px = lambda x, y: data[min(max(y, 0), h - 1) * w + min(max(x, 0), w - 1)]
+        for y in range(h):
+            for x in range(w):
+                s = sum(px(x + i, y + j) * (2 - abs(i)) * (2 - abs(j))
+                        for i in (-1, 0, 1) for j in (-1, 0, 1))
+                assert res.data[y * w + x] == (s // 16 + px(x, y)) % 256
+
+    def test_share_buffers(self):
+        w, h = 7, 5
+        data = array('B', [(i * 37) % 256 for i in range(w * h)])
+        res = []
+        for shared in (True, False):
+            g = Graph()
+            with g:
+                img = Image(w, h, DF_IMAGE_U8, data)
+                chain = [img]
+                for i in range(4):
+                    chain.append(Gaussian3x3(chain[-1]))
+                    if not shared:
+                        chain[-1].force()
+                chain[-1].force()
+            g.process()
+            res.append(chain)
+        a, b, c, d = res[0][1:]
+        assert a.data == c.data and b.data != d.data
+        assert a.shares_buffer and not d.shares_buffer
+        assert list(res[0][-1].as_array()) == list(res[1][-1].as_array())
@@ -1,5 +1,8 @@
 from pyvx import *
 from array import array
+import time
+from math import atan2, pi
+import pytest
 
 class TestPyVx(object):
     def test_gaussian(self):
@@ -94,6 +97,17 @@ class TestPyVx(object):
             assert gimg.data[i] == 3*i + 1
             assert bimg.data[i] == 3*i + 2
 
+    def test_channel_combine(self):
+        g = Graph()
+        with g:
+            img = Image(3, 4, DF_IMAGE_RGB, array('B', range(12*3)))
+            bgr = ChannelCombine(img.channel_b, img.channel_g, img.channel_r)
+            bgr.force()
+        g.verify()
+        g.process()
+        for i in range(12):
+            assert [bgr.data[3*i + c] for c in range(3)] == [3*i + 2, 3*i + 1, 3*i]
+
     def test_channel_extract_uyvu(self):
         g = Graph()
         with g:
@@ -110,6 +124,17 @@ class TestPyVx(object):
         assert [uimg.data[i] for i in range(7)] == [0,0,4,4,8,8,12]
         assert [vimg.data[i] for i in range(7)] == [2,2,6,6,10,10,14]
 
+    def test_color_convert(self):
+        g = Graph()
+        with g:
+            img = Image(2, 1, DF_IMAGE_RGB, array('B', [255, 0, 0, 0, 0, 255]))
+            yuv = ColorConvert(img)
+            yuv.color = DF_IMAGE_UYVY
+            yuv.force()
+        g.verify()
+        g.process()
+        assert [yuv.data[i] for i in range(4)] == [255, 54, 116, 18]
+
     def test_mul_truncate(self):
         g = Graph()
         with g:
@@ -137,6 +162,20 @@ class TestPyVx(object):
         for i, expected in enumerate([0,0,1,2,2,2,3,4,4,4,5,6]):
             assert sa.data[i] == expected
 
+    def test_mul_power_of_two(self):
+        g = Graph()
+        with g:
+            img1 = Image(3, 4, DF_IMAGE_S16, array('h', range(-6, 6)))
+            img2 = Image(3, 4, DF_IMAGE_S16, array('h', [3]*12))
+            sa = img1 * img2
+            sa.producer.scale = 0.25
+            sa.force()
+        g.verify()
+        assert sa.producer.body == "out = in1 * in2 / 4;"
+        g.process()
+        for i, v in enumerate(range(-6, 6)):
+            assert sa.data[i] == int(v * 3 * 0.25)
+
     def test_arithmetic1(self):
         g = Graph()
         with g:
@@ -151,6 +190,43 @@ class TestPyVx(object):
             assert sa1.data[i] == 1
             assert sa2.data[i] == 5 / (i + 1)
 
+    def test_power(self):
+        g = Graph()
+        with g:
+            img = Image(3, 4, DF_IMAGE_U8, array('B', range(1,13)))
+            sq = img ** 2
+            cube = img ** 3
+            root = img ** 0.5
+            other = img ** 1.5
+            for res in (sq, cube, root, other):
+                res.force()
+        g.verify()
+        assert sq.producer.body == "out = in1 * in1;"
+        g.process()
+        for i in range(12):
+            assert sq.data[i] == (i + 1) ** 2
+            assert cube.data[i] == (i + 1) ** 3
+            assert abs(root.data[i] - (i + 1) ** 0.5) < 1e-6
+            assert abs(other.data[i] - (i + 1) ** 1.5) < 1e-4
+
+    def test_true_divide(self):
+        g = Graph()
+        with g:
+            img = Image(3, 4, DF_IMAGE_U8, array('B', range(1,13)))
+            three = Image(3, 4, DF_IMAGE_U8, array('B', [3] * 12))
+            wide = Image(3, 4, DF_IMAGE_U32, array('I', range(1,13)))
+            single = TrueDivide(img, three)
+            double = TrueDivide(wide, img)
+            single.force()
+            double.force()
+        g.verify()
+        assert single.color == DF_IMAGE_F32
+        assert double.color == DF_IMAGE_F64
+        g.process()
+        for i in range(12):
+            assert abs(single.data[i] - (i + 1) / 3.0) < 1e-6
+            assert double.data[i] == 1.0
+
     def test_arithmetic2(self):
         g = Graph()
         with g:
@@ -199,3 +275,129 @@ class TestPyVx(object):
         while g.process() == SUCCESS:
             fcnt += 1
         assert fcnt == 136
+
+    def test_play_pacing(self):
+        class Player(object):
+            live = 0
+            frame_duration = 0.05
+        node = PlayNode.__new__(PlayNode)
+        node.player = Player()
+        t0 = time.time()
+        for i in range(4):
+            node.wait()
+        assert time.time() - t0 >= 0.15
+        node.player.live = 1
+        t0 = time.time()
+        for i in range(4):
+            node.wait()
+        assert time.time() - t0 < 0.05
+        node.player = None
+
+    def test_process_block(self):
+        g = Graph()
+        with g:
+            img = Image(3, 4, DF_IMAGE_U8, array('B', range(12)))
+            gimg = Gaussian3x3(img)
+            gimg.force()
+        assert g.process(block=True) == SUCCESS
+        assert gimg.data[4] == 4
+
+    @pytest.mark.skipif("Graph.use_numba")
+    def test_compile_cache(self, tmpdir, monkeypatch):
+        monkeypatch.delenv('PYVX_NO_CACHE', raising=False)
+        monkeypatch.setattr(Graph, 'cache_dir', str(tmpdir))
+        monkeypatch.setattr(Graph, 'compiled_modules', {})
+        g = Graph()
+        with g:
+            img = Image(3, 4, DF_IMAGE_U8, array('B', range(12)))
+            gimg = Gaussian3x3(img)
+            gimg.force()
+        g.process()
+        assert gimg.data[4] == 4
+        sources = tmpdir.listdir('*.c')
+        assert len(sources) == 1
+        assert '0x' not in sources[0].read().replace(sources[0].purebasename, '')
+        assert len(tmpdir.listdir('*.so')) == 1
+        assert tmpdir.listdir(lambda p: p.check(dir=1)) == []
+
+    @pytest.mark.skipif("Graph.use_numba")
+    def test_compile_cache_host(self, tmpdir, monkeypatch):
+        import pyvx.backend
+        monkeypatch.delenv('PYVX_NO_CACHE', raising=False)
+        monkeypatch.setattr(Graph, 'cache_dir', str(tmpdir))
+        monkeypatch.setattr(Graph, 'compiled_modules', {})
+        for target in ('host1', 'host2', None):
+            monkeypatch.setattr(pyvx.backend, '_native_target', [target])
+            with Graph() as g:
+                img = Image(3, 4, DF_IMAGE_U8, array('B', range(12)))
+                gimg = Gaussian3x3(img)
+                gimg.force()
+            g.process()
+            assert gimg.data[4] == 4
+        # Not cached when the target is unknown
+        assert len(tmpdir.listdir('*.so')) == 2
+
+    @pytest.mark.skipif("Graph.use_numba")
+    def test_compile_cache_evict(self, tmpdir, monkeypatch):
+        monkeypatch.delenv('PYVX_NO_CACHE', raising=False)
+        monkeypatch.setattr(Graph, 'cache_dir', str(tmpdir))
+        monkeypatch.setattr(Graph, 'cache_size', 2)
+        for i in range(3):
+            with Graph() as g:
+                img = Image(3, 4, DF_IMAGE_U8, array('B', range(12)))
+                (img + i).force()
+            g.process()
+        assert len(tmpdir.listdir('*.so')) == len(tmpdir.listdir('*.c')) == 2
+
+    @pytest.mark.skipif("Graph.use_numba")
+    def test_compile_reuse(self):
+        n = len(Graph.compiled_modules)
+        res = []
+        for i in range(2):
+            g = Graph()
+            with g:
+                img = Image(5, 6, DF_IMAGE_U8)
+                gimg = Gaussian3x3(img) + 1
+                gimg.force()
+            g.verify()
+            for j in range(30):
+                img.data[j] = i + j
+            g.process()
+            res.append(gimg)
+        assert len(Graph.compiled_modules) == n + 1
+        assert res[0].data[7] == 8
+        assert res[1].data[7] == 9
+
+    @pytest.mark.skipif("Graph.use_numba")
+    def test_compile_reuse_branches(self):
+        # Independent branches, with unrelated allocations between them
+        # moving the nodes around in memory
+        n = len(Graph.compiled_modules)
+        junk = []
+        for i in range(3):
+            g = Graph()
+            with g:
+                img = Image(8, 6, DF_IMAGE_U8)
+                for j in range(6):
+                    junk.append([object() for k in range((i * 5 + j * 3) % 7)])
+                    if j % 2:
+                        Sobel3x3(img)[0].force()
+                    else:
+                        Gaussian3x3(img).force()
+            g.verify()
+        assert len(Graph.compiled_modules) == n + 1
+
+    def test_phase(self):
+        r = range(-300, 301, 60) + [-1, 1, 32767, -32768]
+        gx = [x for x in r for y in r]
+        gy = [y for x in r for y in r]
+        g = Graph()
+        with g:
+            a = Image(len(r), len(r), DF_IMAGE_S16, array('h', gx))
+            b = Image(len(r), len(r), DF_IMAGE_S16, array('h', gy))
+            p = Phase(a, b)
+            p.force()
+        g.process()
+        for i in range(len(gx)):
+            ref = int((atan2(gy[i], gx[i]) + pi) * (255.0 / 2.0 / pi))
+            assert abs(p.data[i] - ref) <= 1